@@ -18,11 +18,9 @@
 # You should have received a copy of the GNU General Public License along with
 # python-cope. If not, see <http://www.gnu.org/licenses/>.
 
+import math
 import numpy as np
 import scipy.linalg
-# Plots
-from mpl_toolkits.mplot3d import Axes3D
-import matplotlib.pyplot as plt
 
 def TransformInv(T):
   """
@@ -37,10 +35,11 @@ def TransformInv(T):
   @return: The inverse of the input homogeneous transformation
   """
   R = T[:3,:3].T
-  p = T[:3,3]
-  T_inv = np.identity(4)
+  T_inv = np.empty((4,4), dtype=T.dtype)
   T_inv[:3,:3] = R
-  T_inv[:3,3] = np.dot(-R, p)
+  T_inv[:3,3] = -np.dot(R, T[:3,3])
+  T_inv[3,:3] = 0.
+  T_inv[3,3] = 1.
   return T_inv
 
 def TranValidate(T):
@@ -63,10 +62,14 @@ def TranAd(T):
   @param T:   transformation matrix
   """
   C = T[:3,:3]
-  r = T[:3,3]
+  (C00,C01,C02),(C10,C11,C12),(C20,C21,C22) = C.tolist()
+  rx, ry, rz = T[:3,3].tolist()
   AdT = np.zeros([6,6])
   AdT[:3,:3] = C
-  AdT[:3,3:] = np.dot(Hat(r),C)
+  # Hat(r)*C written out entry by entry, column j is the cross product r x C[:,j]
+  AdT[:3,3:] = ((ry*C20 - rz*C10, ry*C21 - rz*C11, ry*C22 - rz*C12),
+                (rz*C00 - rx*C20, rz*C01 - rx*C21, rz*C02 - rx*C22),
+                (rx*C10 - ry*C00, rx*C11 - ry*C01, rx*C12 - ry*C02))
   AdT[3:,3:] = C
   return AdT
 
@@ -77,11 +80,13 @@ def Hat(vec):
   @param vec:   vector of 3 (rotation) or 6 (transformation)
   """
   if vec.shape[0] == 3: # skew from vec
-    return np.array([[0,-vec[2],vec[1]],[vec[2],0,-vec[0]],[-vec[1],vec[0],0]])
+    x, y, z = np.ravel(vec).tolist()
+    return np.array([[0,-z,y],[z,0,-x],[-y,x,0]])
   elif vec.shape[0] == 6:
+    rx, ry, rz, px, py, pz = np.ravel(vec).tolist()
     vechat = np.zeros((4,4))
-    vechat[:3,:3] = Hat(vec[3:])
-    vechat[:3,3] = vec[:3]
+    vechat[:3,:3] = ((0,-pz,py),(pz,0,-px),(-py,px,0))
+    vechat[:3,3] = (rx,ry,rz)
     return vechat
   else:
     raise ValueError("Invalid vector length for hat operator\n")
@@ -91,16 +96,23 @@ def VecFromSkew(r):
   return np.array([r[2,1],r[0,2],r[1,0]])
 
 
-def CurlyHat(vec):
+def CurlyHat(vec, out=None):
   """
   Builds the 6x6 curly hat matrix from the 6x1 input
   @param vec:          a 6x1 vector xi
+  @param out:          optional 6x6 array the matrix is written into and returned
   @param veccurlyhat:  a 6x6 matrix 
   """
-  veccurlyhat = np.zeros((6,6))
-  veccurlyhat[:3,:3] = Hat(vec[3:])
-  veccurlyhat[:3,3:] = Hat(vec[:3])
-  veccurlyhat[3:,3:] = Hat(vec[3:])
+  rx, ry, rz, px, py, pz = np.ravel(vec).tolist()
+  if out is None:
+    veccurlyhat = np.zeros((6,6))
+  else:
+    # Every other block is overwritten below
+    veccurlyhat = out
+    veccurlyhat[3:,:3] = 0
+  # The 18 nonzero entries are written directly, without building Hat(phi) and Hat(rho)
+  veccurlyhat[:3,:3] = veccurlyhat[3:,3:] = ((0,-pz,py),(pz,0,-px),(-py,px,0))
+  veccurlyhat[:3,3:] = ((0,-rz,ry),(rz,0,-rx),(-ry,rx,0))
   return veccurlyhat
 
 
@@ -161,80 +173,77 @@ def RotToVec(C):
   @param return: Return a 3x1 vector (axis*angle) computed from C
   """
   # RotValidate(C)
-  epsilon = 0.0001
-  epsilon2 = 0.001
-  if ((abs(C[0,1]-C[1,0])<epsilon) and (abs(C[0,2]-C[2,0])<epsilon) and (abs(C[1,2]-C[2,1])<epsilon)):
-    # singularity found
-    # first check for identity matrix which must have +1 for all terms
-		# in leading diagonaland zero in other terms
-    if ((abs(C[0,1]+C[1,0]) < epsilon2) and (abs(C[0,2]+C[2,0]) < epsilon2) and (abs(C[1,2]+C[2,1]) < epsilon2) and (abs(C[0,0]+C[1,1]+C[2,2]-3) < epsilon2)): # this singularity is identity matrix so angle = 0
-      return np.zeros(3) #zero angle, arbitrary axis 
-    # otherwise this singularity is angle = 180
-    angle = np.pi
-    xx = (C[0,0]+1)/2.
-    yy = (C[1,1]+1)/2.
-    zz = (C[2,2]+1)/2.
-    xy = (C[0,1]+C[1,0])/4.
-    xz = (C[0,2]+C[2,0])/4.
-    yz = (C[1,2]+C[2,1])/4.
-    if ((xx > yy) and (xx > zz)): # C[0][0] is the largest diagonal term
-      if (xx< epsilon):
-        x = 0
-        y = np.sqrt(2)/2.
-        z = np.sqrt(2)/2.
-      else:
-        x = np.sqrt(xx)
-        y = xy/x
-        z = xz/x
-    elif (yy > zz): # C[1][1] is the largest diagonal term
-      if (yy< epsilon):
-        x = np.sqrt(2)/2.
-        y = 0
-        z = np.sqrt(2)/2.
-      else:
-        y = np.sqrt(yy)
-        x = xy/y
-        z = yz/y
-    else: # C[2][2] is the largest diagonal term so base result on this
-      if (zz< epsilon):
-        x = np.sqrt(2)/2.
-        y = np.sqrt(2)/2.
-        z = 0
-      else:
-        z = np.sqrt(zz)
-        x = xz/z
-        y = yz/z
-    return angle*np.array((x,y,z))
-  s = np.sqrt((C[2,1] - C[1,2])*(C[2,1] - C[1,2])+(C[0,2] - C[2,0])*(C[0,2] - C[2,0])+(C[1,0] - C[0,1])*(C[1,0] - C[0,1])) # used to normalise
-  if (abs(s) < 0.001):
-    # prevent divide by zero, should not happen if matrix is orthogonal and should be
-    # caught by singularity test above, but I've left it in just in case
-    s=1 
-        
-  angle = np.arccos(( C[0,0] + C[1,1] + C[2,2] - 1)/2.)
-  x = (C[2,1] - C[1,2])/s
-  y = (C[0,2] - C[2,0])/s
-  z = (C[1,0] - C[0,1])/s
-  return angle*np.array((x,y,z))
-
-def VecToRot(phi):
+  # Read the entries once as python floats, scalar math is much cheaper than numpy on single elements
+  (C00,C01,C02),(C10,C11,C12),(C20,C21,C22) = np.asarray(C).tolist()
+  # The skew part of C is 2*sin(angle)*axis
+  wx = C21 - C12
+  wy = C02 - C20
+  wz = C10 - C01
+  s = math.sqrt(wx*wx + wy*wy + wz*wz)
+  cos_angle = min(1.,max(-1.,(C00 + C11 + C22 - 1)/2.))
+  angle = math.atan2(0.5*s, cos_angle)
+  if cos_angle > 0 or s > 1e-4:
+    # angle/(2*sin(angle)) tends to 1/2 when the angle goes to 0
+    k = angle/s if s > 1e-12 else 0.5
+    return np.array((k*wx,k*wy,k*wz))
+  # angle close to pi, the skew part vanishes so the axis is recovered from the
+  # symmetric part: (C + C.T)/2 = cos(angle)*I + (1-cos(angle))*axis*axis.T
+  a = 1. - cos_angle
+  xx = (C00 - cos_angle)/a
+  yy = (C11 - cos_angle)/a
+  zz = (C22 - cos_angle)/a
+  xy = (C01 + C10)/(2*a)
+  xz = (C02 + C20)/(2*a)
+  yz = (C12 + C21)/(2*a)
+  if ((xx > yy) and (xx > zz)): # C[0][0] is the largest diagonal term
+    x = math.sqrt(xx)
+    y = xy/x
+    z = xz/x
+  elif (yy > zz): # C[1][1] is the largest diagonal term
+    y = math.sqrt(yy)
+    x = xy/y
+    z = yz/y
+  else: # C[2][2] is the largest diagonal term so base result on this
+    z = math.sqrt(zz)
+    x = xz/z
+    y = yz/z
+  if s > 1e-12 and x*wx + y*wy + z*wz < 0:
+    # the axis sign is still given by the skew part when the angle is not exactly pi
+    x, y, z = -x, -y, -z
+  return np.array((angle*x,angle*y,angle*z))
+
+def VecToRot(phi, out=None):
   """
   Return a rotation matrix computed from the input vec (phi 3x1)
   @param phi: 3x1 vector (input)
+  @param out: optional 3x3 array the rotation matrix is written into
   @param C:   3x3 rotation matrix (output)
   """
   tiny = 1e-12
+  x, y, z = np.ravel(np.asarray(phi,dtype=np.float64)).tolist()
   #check for small angle
-  nr = np.linalg.norm(phi)
+  nr = math.sqrt(x*x + y*y + z*z)
   if nr < tiny:
     #~ # If the angle (nr) is small, fall back on the series representation.
     # C = VecToRotSeries(phi,10)
-    C = np.eye(3)
+    s = 1.
+    c = 0.5
   else:
-    R = Hat(phi)
-    C = np.eye(3) + np.sin(nr)/nr*R + (1-np.cos(nr))/(nr*nr)*np.dot(R,R)
-  return C
-
+    # Rodrigues' formula C = I + s*Hat(phi) + c*Hat(phi)^2, (1-cos(nr))/nr^2 is
+    # evaluated as 2*sin(nr/2)^2/nr^2 to avoid cancellation at small angles
+    s = math.sin(nr)/nr
+    c = math.sin(0.5*nr)/nr
+    c = 2*c*c
+  xy = c*x*y
+  xz = c*x*z
+  yz = c*y*z
+  C = ((1 - c*(y*y + z*z), xy - s*z, xz + s*y),
+       (xy + s*z, 1 - c*(x*x + z*z), yz - s*x),
+       (xz - s*y, yz + s*x, 1 - c*(x*x + y*y)))
+  if out is None:
+    return np.array(C)
+  out[...] = C
+  return out
 
 def VecToRotSeries(phi, N):
   """"
@@ -557,12 +566,13 @@ def Fusing(Tlist, sigmalist, N = 0, maxiterations=30, retiter=False):
   kmax = len(Tlist)
   
   T = Tlist[0]
+  Tinvlist = [TransformInv(Tk) for Tk in Tlist]
   Vprv = 0
   for i in range(maxiterations): # Gauss-Newton iterations
     LHS = np.zeros(6)
     RHS = np.zeros(6)
     for k in range(kmax):
-      xik = TranToVec(np.dot(T,np.linalg.inv(Tlist[k])))
+      xik = TranToVec(np.dot(T,Tinvlist[k]))
       if N ==0:
         invJ = VecToJacInv(xik)
       else:
@@ -578,7 +588,7 @@ def Fusing(Tlist, sigmalist, N = 0, maxiterations=30, retiter=False):
     # How low did the objective function get?
     V = 0.
     for k in range(kmax):
-      xik = TranToVec(np.dot(T,np.linalg.inv(Tlist[k])))
+      xik = TranToVec(np.dot(T,Tinvlist[k]))
       V = V + np.dot(np.dot(xik.T,np.linalg.inv(sigmalist[k])),xik) / 2.
     if abs(V - Vprv) < 1e-10:
       break 
@@ -592,7 +602,7 @@ def CovInverseTran(T,sigma):
     """
     Compute the cov of the inverse transformation. (Follow Ethan Eade's note on lie group.)
     """
-    Tinv = np.linalg.inv(T)
+    Tinv = TransformInv(T)
     AdTinv = TranAd(Tinv)
     sigmaTinv = np.dot(np.dot(AdTinv,sigma),np.transpose(AdTinv))
     return Tinv, sigmaTinv
@@ -601,7 +611,7 @@ def CovInverseTranWithSeparateRotTrans(R,sigmaR,t,sigmat):
     """
     Compute the cov of the inverse transformation where Rot and Trans 's noises are assumed to be independent
     """
-    Rinv = np.linalg.inv(R)
+    Rinv = np.transpose(R)
     tinv = -np.dot(Rinv,t)
     sigmaRinv = sigmaR
     hatRinvt = Hat(np.dot(Rinv,t))
@@ -615,6 +625,9 @@ def Visualize(Tlist,sigmalist, nsamples = 100):
   @param sigmalist: a list of corresponding sigmas
   @param nsamples:  the number of samples generated for each (T,sigma)
   """
+  # Plots, imported here so that the library does not load matplotlib
+  from mpl_toolkits.mplot3d import Axes3D
+  import matplotlib.pyplot as plt
   import matplotlib.cm as cm
   fig = plt.figure()
   ax = fig.add_subplot(111, projection='3d')
@@ -26,9 +26,6 @@ import random
 
 import cope.SE3lib as SE3
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
-plt.ion()
 
 def Eigsorted(cov):
     vals, vecs = np.linalg.eigh(cov)
@@ -36,6 +33,10 @@ def Eigsorted(cov):
     return vals[order], vecs[:,order]
 
 def VisualizeCovariances(cov_rot, cov_trans, minx,maxx,miny,maxy):
+  # Plots, imported here so that the library does not load matplotlib
+  import matplotlib.pyplot as plt
+  from matplotlib.patches import Ellipse
+  plt.ion()
   plt.subplot(231) # x and y axis
   nstd=1
   alpha = 0.5
@@ -164,6 +165,9 @@ def VisualizeCovariances(cov_rot, cov_trans, minx,maxx,miny,maxy):
   return True
 
 def VisualizeRealEstCov(cov_real, cov_est, minx,maxx,miny,maxy,param):
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
+    plt.ion()
     if param=='rot':
         subplotnum = 230
     if param=='trans':
@@ -377,10 +381,12 @@ def IterativeSolutionTrans(beta, alpha, ta, tb, Rx, sigmaRa, sigmaRb, sigmata, s
             Xk[:3] = np.zeros((3,1))
             Xk[3:6] = (np.dot(Rx,tb[k])-ta[k]).reshape(3,1)
             Xkhat = np.zeros((6,1))
-            if math.isnan((SE3.RotToVec(np.dot(Rahat[k], np.linalg.inv(Ra[k])))).reshape((3,1))[0]):
+            # Ra[k] is a rotation, its inverse is its transpose
+            xiRak = SE3.RotToVec(np.dot(Rahat[k], np.transpose(Ra[k]))).reshape((3,1))
+            if math.isnan(xiRak[0]):
                 Xkhat[:3] = np.zeros((3,1))
             else:
-                Xkhat[:3] = (SE3.RotToVec(np.dot(Rahat[k], np.linalg.inv(Ra[k])))).reshape((3,1))
+                Xkhat[:3] = xiRak
             Xkhat[3:6] = qhat[k].reshape(3,1)
             ek = Xk - Xkhat
             eA += np.dot(np.dot(np.transpose(Ak),inv_sigmaX[k]),ek)
@@ -22,18 +22,17 @@ import numpy  as np
 import trimesh
 import scipy as sp
 from scipy.stats import norm
+from scipy.spatial import cKDTree
 import cope.SE3lib as SE3
-import bisect
 import cope.transformation as tr
 import random
+import math
 import time
-import copy
-import matplotlib.pyplot as plt
 
 
 class Region(object):
   def __init__(self, particles, delta_rot,delta_trans):
-    self.particles = particles #List of particles (transformations)
+    self.particles = np.asarray(particles).reshape(-1,4,4) #Stack of particles (transformations), num_particles x 4 x 4
     self.delta_rot = delta_rot
     self.delta_trans = delta_trans
 
@@ -42,172 +41,431 @@ def IsInside(point,center,radius):
     return True
   return False
 
+def InsideBalls(points,center,radius):
+  """
+  Vectorized IsInside, test each row of points (Nx3) against the ball (center,radius).
+  points and center broadcast against each other along all but the last axis
+  """
+  diff = points - center
+  return np.einsum('...k,...k->...',diff,diff) < radius*radius
+
 
 def EvenDensityCover(region, M):
   '''Input: Region V_n - sampling region represented as a union of neighborhoods, M - number of particles to sample per neighborhood
   Output: a set of particles that evenly cover the region (the new spheres will have analogous shape to the region sigma)
   '''
-  particles = []
   num_spheres = len(region.particles)
   delta_rot = region.delta_rot
   delta_trans = region.delta_trans
+  centers_rot = np.array([SE3.RotToVec(center_particle[:3,:3]) for center_particle in region.particles]).reshape(-1,3)
+  centers_trans = region.particles[:,:3,3]
+  # kd-tree of the centers with rotation and translation scaled by the neighborhood sizes,
+  # a point inside both balls of a center is closer than sqrt(2) to it in this space.
+  # The candidates of center i are drawn in a box of half-diagonal sqrt(6) around it, so
+  # the centers that can contain them are queried once per center rather than per candidate
+  scale = np.hstack([np.full(3,1./delta_rot),np.full(3,1./delta_trans)])
+  centers_tree = cKDTree(np.hstack([centers_rot,centers_trans])*scale)
+  max_tries = 5
+  # At most M particles are drawn per center, they are written in place in one stack
+  # stored in float32, the maps to and from rotation vectors run in float64
+  particles = np.zeros((num_spheres*M,4,4),dtype=np.float32)
+  particles[:,3,3] = 1
+  num_particles = 0
+  # Number of accepted particles inside the neighborhood of each center
+  num_inside = np.zeros(num_spheres,dtype=int)
   for i  in range(num_spheres):
-    center_particle = region.particles[i]
-    center_vec_rot =  SE3.RotToVec(center_particle[:3,:3])
-    center_vec_trans = center_particle[:3,3]
-    num_existing = 0
-    for p in particles:
-      if IsInside(SE3.RotToVec(p[:3,:3]),center_vec_rot,delta_rot) and IsInside(p[:3,3],center_vec_trans,delta_trans):
-        num_existing += 1
-    for m in range(M-num_existing):
-      count = 0
-      accepted = False
-      while not accepted and count < 5:
-        new_vec_rot = np.random.uniform(-1,1,size = 3)*delta_rot + center_vec_rot
-        new_vec_trans = np.random.uniform(-1,1,size = 3)*delta_trans + center_vec_trans
-        count += 1
-        accepted = True
-        for k in range(i-1):
-          previous_center = region.particles[k]
-          previous_vec_rot = SE3.RotToVec(previous_center[:3,:3])
-          previous_vec_trans = previous_center[:3,3]
-          if IsInside(SE3.RotToVec(p[:3,:3]),previous_vec_rot,delta_rot) and IsInside(p[:3,3],previous_vec_trans,delta_trans):
-            accepted = False
-            break
-      if accepted:
-        new_p = np.eye(4)
-        new_p[:3,:3] = SE3.VecToRot(new_vec_rot)
-        new_p[:3,3] = new_vec_trans
-        particles.append(new_p)
-  return particles
+    center_vec_rot =  centers_rot[i]
+    center_vec_trans = centers_trans[i]
+    num_existing = num_inside[i]
+    if num_existing >= M:
+      continue
+    neighbors = np.asarray(centers_tree.query_ball_point(np.hstack([center_vec_rot,center_vec_trans])*scale,np.sqrt(6)+np.sqrt(2)),dtype=int)
+    neighbors_rot = centers_rot[neighbors]
+    neighbors_trans = centers_trans[neighbors]
+    # Draw every try of every new particle at once, the acceptance of a try only depends on
+    # the previous centers so the particles of this center can be tested together
+    num_new = M-num_existing
+    new_vecs_rot = np.random.uniform(-1,1,size = (num_new,max_tries,3))*delta_rot + center_vec_rot
+    new_vecs_trans = np.random.uniform(-1,1,size = (num_new,max_tries,3))*delta_trans + center_vec_trans
+    # inside[m,k,j]: the k-th try of the m-th particle is in the neighborhood of center neighbors[j]
+    inside = InsideBalls(new_vecs_rot[:,:,np.newaxis],neighbors_rot,delta_rot) & InsideBalls(new_vecs_trans[:,:,np.newaxis],neighbors_trans,delta_trans)
+    # Reject tries falling inside the neighborhood of a previous center, keep the first accepted one
+    accepted = ~np.any(inside[:,:,neighbors < i],axis=2)
+    first = np.argmax(accepted,axis=1)
+    new_rows = np.flatnonzero(accepted[np.arange(num_new),first])
+    for m in new_rows:
+      SE3.VecToRot(new_vecs_rot[m,first[m]],out=particles[num_particles,:3,:3])
+      num_particles += 1
+    particles[num_particles-len(new_rows):num_particles,:3,3] = new_vecs_trans[new_rows,first[new_rows]]
+    num_inside[neighbors] += np.sum(inside[new_rows,first[new_rows]],axis=0)
+  return particles[:num_particles]
 
 def normalize(weights):
-  norm_weights = np.zeros(len(weights))
+  weights = np.asarray(weights,dtype=np.float64)
   sum_weights = np.sum(weights)
   if sum_weights == 0:
-    return np.ones(len(weights))/len(weights)
-  for i in range(len(weights)):
-    norm_weights[i] = weights[i]/sum_weights
-  return norm_weights
+    return np.full_like(weights,1./len(weights))
+  return weights/sum_weights
+
+def UnitNormal(normal):
+  normal = np.asarray(normal,dtype=np.float64)
+  return normal/np.linalg.norm(normal)
 
-def ComputeNormalizedWeightsB(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau):
+def TransformMeasurements(particles,measurements,dtype=np.float64):
+  """
+  Move the measurements to the frame of every particle at once.
+  @param particles:    A list (or stack) of 4x4 transformations
+  @param measurements: A list of [position, normal] pairs, normals need not be unit
+  @param dtype:        Precision of the computation
+  @return positions_t, normals_t: Two arrays of shape num_particles x num_measurements x 3
+  """
+  # Closed-form inverse x' = R.T*(x-t), written for row vectors as (x-t)*R
+  # (num_measurements,3) even without measurements
+  positions = np.asarray([m[0] for m in measurements],dtype=np.float64).reshape(-1,3)
+  normals = np.asarray([m[1] for m in measurements],dtype=np.float64).reshape(-1,3)
+  normals /= np.linalg.norm(normals,axis=1)[:,np.newaxis]
+  positions = positions.astype(dtype)
+  normals = normals.astype(dtype)
+  stacked_particles = np.asarray(particles,dtype=dtype).reshape(-1,4,4)
+  R = stacked_particles[:,:3,:3]
+  t = stacked_particles[:,:3,3]
+  positions_t = np.matmul(positions[np.newaxis]-t[:,np.newaxis],R)
+  normals_t = np.matmul(normals,R)
+  return positions_t,normals_t
+
+def BuildFaceTree(mesh):
+  """
+  FaceTree of the mesh for ComputeNormalizedWeightsB, or None for small meshes
+  """
+  # Only evaluate the faces near each measurement, past a few dozen faces this
+  # is faster than the exhaustive scan and gives the same minimum
+  if len(mesh.faces) > 64:
+    return FaceTree(mesh)
+  return None
+
+def ComputeNormalizedWeightsB(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau,face_tree=None):
+  """
+  @param face_tree: BuildFaceTree(mesh) of a caller evaluating the same mesh many times,
+                    built here when not given
+  """
   num_particles = len(particles)
-  new_weights = np.zeros(num_particles)
-  for i in range(len(particles)):
-    T = np.linalg.inv(particles[i])
-    D = copy.deepcopy(measurements)
-    for d in D:
-      d[0] = np.dot(T[:3,:3],d[0]) + T[:3,3]
-      d[1] = np.dot(T[:3,:3],d[1])
-    total_energy = sum([FindminimumDistanceMeshOriginal(mesh,sorted_face,measurement,pos_err,nor_err)**2 for measurement in D])
-    new_weights[i] = (np.exp(-0.5*total_energy/tau))
-  return normalize(new_weights)
-
-def ComputeNormalizedWeights(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau):
+  energies = np.zeros(num_particles)
+  positions_t,normals_t = TransformMeasurements(particles,measurements,dtype=np.float32)
+  num_measurements = len(measurements)
+  if face_tree is None:
+    # Small meshes have no tree, the check is then repeated at no cost
+    face_tree = BuildFaceTree(mesh)
+  if face_tree is not None:
+    chunk = max(1,num_particles)
+  else:
+    # The particles are independent, evaluate them in chunks of about 2**20 (measurement, face) pairs
+    chunk = max(1,2**20//(max(1,num_measurements)*len(mesh.faces)))
+  for i in range(0,num_particles,chunk):
+    dist_sq = FindminimumDistancesMeshOriginal(mesh,positions_t[i:i+chunk].reshape(-1,3),normals_t[i:i+chunk].reshape(-1,3),pos_err,nor_err,face_tree,squared=True)
+    energies[i:i+chunk] = np.sum(dist_sq.astype(np.float64).reshape(positions_t[i:i+chunk].shape[:2]),axis=1)
+  # Shift by the lowest energy before taking the exponential in one pass, the best
+  # particle gets weight 1 so the normalization cannot underflow to all zeros
+  energies -= np.min(energies)
+  new_weights = np.exp(-0.5*energies/tau)
+  return new_weights/np.sum(new_weights)
+
+def ComputeNormalizedWeights(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau,prepared_face=None):
+  """
+  @param prepared_face: PrepareSortedFace(mesh,sorted_face) of a caller evaluating the same
+                        mesh many times, prepared here when not given
+  """
   num_particles = len(particles)
-  new_weights = np.zeros(num_particles)
-  for i in range(len(particles)):
-    T = np.linalg.inv(particles[i])
-    D = copy.deepcopy(measurements)
-    for d in D:
-      d[0] = np.dot(T[:3,:3],d[0]) + T[:3,3]
-      d[1] = np.dot(T[:3,:3],d[1])
-    total_energy = sum([FindminimumDistanceMesh(mesh,sorted_face,measurement,pos_err,nor_err)**2 for measurement in D])
-    new_weights[i] = (np.exp(-0.5*total_energy/tau))
-  
-  return normalize(new_weights)
-
-
-def FindminimumDistanceMesh(mesh,sorted_face,measurement,pos_err,nor_err):
-    ref_vec = sorted_face[2]
-    sorted_angle = sorted_face[1]
-    face_idx = sorted_face[0]
-    angle =  np.arccos(np.dot(measurement[1],ref_vec))
-    idx = bisect.bisect_right(sorted_angle,angle)
-    if idx >= len(sorted_angle):
-      up_bound = idx
-    else:
-      up_bound = idx + bisect.bisect_right(sorted_angle[idx:],sorted_angle[idx]+sorted_angle[idx]-angle+nor_err)
-    if idx == 0:
-      low_bound = 0
-    else:
-      low_bound = bisect.bisect_left(sorted_angle[:idx],sorted_angle[idx-1]-(sorted_angle[idx-1]-angle)-nor_err)-1
-    dist = []
-    for i in range(low_bound,up_bound):
-        A,B,C = mesh.faces[face_idx[i]]
-        dist.append(CalculateDistanceFace([mesh.vertices[A],mesh.vertices[B],mesh.vertices[C],mesh.face_normals[face_idx[i]]],measurement,pos_err,nor_err))
-    return min(dist)
+  energies = np.zeros(num_particles)
+  positions_t,normals_t = TransformMeasurements(particles,measurements,dtype=np.float32)
+  if prepared_face is None:
+    prepared_face = PrepareSortedFace(mesh,sorted_face)
+  # The particles are independent, evaluate the measurements of a chunk of particles together
+  num_measurements = len(measurements)
+  chunk = max(1,2**12//max(1,num_measurements))
+  for i in range(0,num_particles,chunk):
+    dist_sq = FindminimumDistancesMesh(mesh,prepared_face,positions_t[i:i+chunk].reshape(-1,3),normals_t[i:i+chunk].reshape(-1,3),pos_err,nor_err,squared=True)
+    energies[i:i+chunk] = np.sum(dist_sq.astype(np.float64).reshape(positions_t[i:i+chunk].shape[:2]),axis=1)
+  # Shift by the lowest energy before taking the exponential in one pass, the best
+  # particle gets weight 1 so the normalization cannot underflow to all zeros
+  energies -= np.min(energies)
+  new_weights = np.exp(-0.5*energies/tau)
+  return new_weights/np.sum(new_weights)
+
+
+def PrepareSortedFace(mesh,sorted_face):
+    """
+    Contiguous arrays for FindminimumDistancesMesh, to be built once per mesh and passed to
+    every weight evaluation of that mesh
+    @param sorted_face: [face_idx, sorted_angle, ref_vec] as returned by NormalHashing
+    @param return:      [face_idx, sorted_angle, ref_vec, triangles, face_normals] where the
+                        triangles and unit normals are stored in the order of face_idx, in
+                        float32 like the particles
+    """
+    face_idx = np.asarray(sorted_face[0])
+    sorted_angle = np.asarray(sorted_face[1],dtype=np.float64)
+    triangles = np.ascontiguousarray(mesh.triangles[face_idx],dtype=np.float32)
+    face_normals = np.ascontiguousarray(mesh.face_normals[face_idx],dtype=np.float32)
+    return [face_idx,sorted_angle,sorted_face[2],triangles,face_normals]
+
+def FindminimumDistanceMesh(mesh,sorted_face,measurement,pos_err,nor_err,prepared_face=None):
+    """
+    @param prepared_face: PrepareSortedFace(mesh,sorted_face), prepared here when not given
+    """
+    if prepared_face is None:
+      prepared_face = PrepareSortedFace(mesh,sorted_face)
+    positions = np.asarray(measurement[0])[np.newaxis]
+    # The measured normal need not be unit, the kernels assume it is
+    normals = UnitNormal(measurement[1])[np.newaxis]
+    return FindminimumDistancesMesh(mesh,prepared_face,positions,normals,pos_err,nor_err)[0]
+
+def FindminimumDistancesMesh(mesh,prepared_face,positions,normals,pos_err,nor_err,squared=False):
+    """
+    FindminimumDistanceMesh for many measurements, the candidate faces of all the
+    measurements are searched and evaluated together
+    @param prepared_face: PrepareSortedFace(mesh,sorted_face)
+    @param positions: (k,3) measured positions
+    @param normals:   (k,3) unit measured normals
+    @param squared:   return the squared distances, the square root is then never taken
+    @param return:    (k,) minimum distance of each measurement
+    """
+    ref_vec = prepared_face[2]
+    sorted_angle = prepared_face[1]
+    num_faces = len(sorted_angle)
+    angles = np.arccos(np.clip(np.dot(normals,ref_vec),-1.,1.))
+    # Binary searches over the whole array: sorted_angle[:idx] <= angle < sorted_angle[idx:]
+    idx = np.searchsorted(sorted_angle,angles,side='right')
+    up_bound = np.searchsorted(sorted_angle,2*sorted_angle[np.minimum(idx,num_faces-1)]-angles+nor_err,side='right')
+    up_bound[idx == num_faces] = num_faces
+    low_bound = np.searchsorted(sorted_angle,angles-nor_err,side='left')-1
+    low_bound[idx == 0] = 0
+    # Concatenate the candidate ranges, each holds at least one face
+    counts = up_bound - low_bound
+    starts = np.cumsum(counts) - counts
+    candidates = np.arange(np.sum(counts)) + np.repeat(low_bound-starts,counts)
+    measurement = [np.repeat(positions,counts,axis=0),np.repeat(normals,counts,axis=0)]
+    dist_sq = MinimumSquaredDistanceSegments(np.take(prepared_face[3],candidates,axis=0),np.take(prepared_face[4],candidates,axis=0),measurement,starts,pos_err,nor_err)
+    return dist_sq if squared else np.sqrt(dist_sq)
 
 def FindminimumDistanceMeshOriginal(mesh,sorted_face,measurement,pos_err,nor_err):
-    dist = []
-    for i in range(len(mesh.faces)):
-        A,B,C = mesh.faces[i]
-        dist.append(CalculateDistanceFace([mesh.vertices[A],mesh.vertices[B],mesh.vertices[C],mesh.face_normals[i]],measurement,pos_err,nor_err))
-    return min(dist)
+    measurement = [measurement[0],UnitNormal(measurement[1])]
+    dist_sq = CalculateSquaredDistanceFaces(mesh.triangles,mesh.face_normals,measurement,pos_err,nor_err)
+    return np.sqrt(np.min(dist_sq))
+
+def FindminimumDistancesMeshOriginal(mesh,positions,normals,pos_err,nor_err,face_tree=None,squared=False):
+    """
+    FindminimumDistanceMeshOriginal for many measurements, every (measurement, face)
+    pair is evaluated in a single call of CalculateDistanceFaces
+    @param positions: (k,3) measured positions
+    @param normals:   (k,3) unit measured normals
+    @param face_tree: optional FaceTree of the mesh, only the faces that can hold the
+                      minimum are then evaluated
+    @param squared:   return the squared distances, the square root is then never taken
+    @param return:    (k,) minimum distance of each measurement
+    """
+    if face_tree is not None:
+      dist_sq = FindminimumDistancesFaceTree(face_tree,positions,normals,pos_err,nor_err)
+      return dist_sq if squared else np.sqrt(dist_sq)
+    num_measurements = len(positions)
+    num_faces = len(mesh.faces)
+    triangles = np.tile(mesh.triangles,(num_measurements,1,1))
+    face_normals = np.tile(mesh.face_normals,(num_measurements,1))
+    measurement = [np.repeat(positions,num_faces,axis=0),np.repeat(normals,num_faces,axis=0)]
+    dist_sq = CalculateSquaredDistanceFaces(triangles,face_normals,measurement,pos_err,nor_err)
+    dist_sq = np.min(dist_sq.reshape(num_measurements,num_faces),axis=1)
+    return dist_sq if squared else np.sqrt(dist_sq)
+
+class FaceTree(object):
+  """
+  kd-tree of the face centroids of a mesh, built once and reused for all the
+  measurements of all the particles by FindminimumDistancesMeshOriginal
+  """
+  def __init__(self, mesh, num_nearest=4):
+    # float32 like the particles, the distances are accumulated in float64 by the caller
+    self.triangles = np.ascontiguousarray(mesh.triangles,dtype=np.float32)
+    self.face_normals = np.ascontiguousarray(mesh.face_normals,dtype=np.float32)
+    centroids = np.mean(mesh.triangles,axis=1)
+    # Every point of a face lies within radius of its centroid
+    self.radius = np.max(np.linalg.norm(mesh.triangles-centroids[:,np.newaxis],axis=2))
+    self.tree = cKDTree(centroids)
+    self.num_nearest = min(num_nearest,len(centroids))
+
+def FindminimumDistancesFaceTree(face_tree,positions,normals,pos_err,nor_err):
+    """
+    Squared minimum distances of the measurements, searched with a FaceTree
+    """
+    num_nearest = face_tree.num_nearest
+    # Upper bound on the minimum from the faces with the nearest centroids
+    nearest = face_tree.tree.query(positions,k=num_nearest)[1].reshape(-1)
+    measurement = [np.repeat(positions,num_nearest,axis=0),np.repeat(normals,num_nearest,axis=0)]
+    dist_sq = CalculateSquaredDistanceFaces(face_tree.triangles[nearest],face_tree.face_normals[nearest],measurement,pos_err,nor_err)
+    upper = np.min(dist_sq.reshape(-1,num_nearest),axis=1)
+    # A face scores at least its distance over pos_err, so a face scoring less than upper
+    # has its centroid within sqrt(upper)*pos_err + radius of the measurement
+    radii = np.sqrt(upper)*pos_err + face_tree.radius
+    candidates = [face_tree.tree.query_ball_point(position,radius) for position,radius in zip(positions,radii)]
+    counts = np.array([len(c) for c in candidates])
+    nonempty = np.flatnonzero(counts)
+    if len(nonempty) == 0:
+      return upper
+    starts = np.cumsum(counts[nonempty]) - counts[nonempty]
+    candidates = np.concatenate([candidates[i] for i in nonempty]).astype(int)
+    measurement = [np.repeat(positions[nonempty],counts[nonempty],axis=0),np.repeat(normals[nonempty],counts[nonempty],axis=0)]
+    dist_sq = MinimumSquaredDistanceSegments(face_tree.triangles[candidates],face_tree.face_normals[candidates],measurement,starts,pos_err,nor_err)
+    upper[nonempty] = np.minimum(upper[nonempty],dist_sq)
+    return upper
 
 def CalculateDistanceFace(face,measurement,pos_err,nor_err):
     p1,p2,p3,nor = face
+    px,py,pz = np.asarray(measurement[0],dtype=np.float64).tolist()
+    mx,my,mz = np.asarray(measurement[1],dtype=np.float64).tolist()
+    nx,ny,nz = np.asarray(nor,dtype=np.float64).tolist()
+    closest_point = ClosestPointTriangles(np.array([[p1,p2,p3]],dtype=np.float64),[px,py,pz])
+    cx,cy,cz = closest_point[0].tolist()
+    diff_distance_sq = (cx-px)**2 + (cy-py)**2 + (cz-pz)**2
+    cos_angle = (nx*mx + ny*my + nz*mz)/math.sqrt((nx*nx + ny*ny + nz*nz)*(mx*mx + my*my + mz*mz))
+    diff_angle = math.acos(min(1.,max(-1.,cos_angle)))
+    return math.sqrt(diff_distance_sq/pos_err**2 + diff_angle**2/nor_err**2)
+
+def ClosestPointTriangles(triangles,point):
+    """
+    Closest point on each triangle to a point, Ericson's region test
+    (Real-Time Collision Detection, 5.1.5) evaluated on all triangles at once
+    @param triangles: (n,3,3) vertices of the triangles
+    @param point:     3x1 query point, or (n,3) with one query point per triangle
+    @param return:    (n,3) closest points
+    """
+    # Work on contiguous x, y, z rows (structure of arrays) rather than on strided
+    # (n,3) views, the closest point is a + s*ab + t*ac
+    a,b,c = np.ascontiguousarray(np.transpose(triangles,(1,2,0)))
+    point = np.asarray(point)
+    if point.ndim == 1:
+      point = point[:,np.newaxis]
+    else:
+      point = np.ascontiguousarray(point.T)
+    ab = b - a
+    ac = c - a
+    ap = point - a
+    bp = point - b
+    cp = point - c
+    inner = lambda u, v: u[0]*v[0] + u[1]*v[1] + u[2]*v[2]
+    d1 = inner(ab,ap)
+    d2 = inner(ac,ap)
+    d3 = inner(ab,bp)
+    d4 = inner(ac,bp)
+    d5 = inner(ab,cp)
+    d6 = inner(ac,cp)
+    va = d3*d6 - d5*d4
+    vb = d5*d2 - d1*d6
+    vc = d1*d4 - d3*d2
+    with np.errstate(divide='ignore',invalid='ignore'):
+      # Start from the projection inside the face, then overwrite with the edge and vertex
+      # regions in reverse order of Ericson's tests so that the first matching test wins
+      denom = 1./(va + vb + vc)
+      s = vb*denom
+      t = vc*denom
+      w = (d4 - d3)/((d4 - d3) + (d5 - d6))
+      region = (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+      s[region] = 1 - w[region]
+      t[region] = w[region]
+      w = d2/(d2 - d6)
+      region = (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+      s[region] = 0
+      t[region] = w[region]
+      region = (d6 >= 0) & (d5 <= d6)
+      s[region] = 0
+      t[region] = 1
+      w = d1/(d1 - d3)
+      region = (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+      s[region] = w[region]
+      t[region] = 0
+      region = (d3 >= 0) & (d4 <= d3)
+      s[region] = 1
+      t[region] = 0
+      region = (d1 <= 0) & (d2 <= 0)
+      s[region] = 0
+      t[region] = 0
+    return np.transpose(a + ab*s + ac*t)
+
+def CalculateDistanceFaces(triangles,normals,measurement,pos_err,nor_err):
+    """
+    Vectorized CalculateDistanceFace, return the distances from the measurement to each face.
+    Both the face normals (as given by trimesh) and the measured normal must be unit vectors.
+    @param triangles:   (n,3,3) vertices of the faces
+    @param normals:     (n,3) unit normals of the faces
+    @param measurement: [position, normal], each either 3x1 or (n,3) with one measurement per face
+    """
+    return np.sqrt(CalculateSquaredDistanceFaces(triangles,normals,measurement,pos_err,nor_err))
+
+def CalculateSquaredDistanceFaces(triangles,normals,measurement,pos_err,nor_err):
+    """
+    Squares of CalculateDistanceFaces, cheaper to compare when only the minimum is needed
+    """
     pos_measurement = measurement[0]
     nor_measurement = measurement[1]
-    norm = lambda x: np.linalg.norm(x)
-    inner = lambda a, b: np.inner(a,b)
-    closest_point = trimesh.triangles.closest_point([[p1,p2,p3]],[pos_measurement])
-    diff_distance = norm(closest_point-pos_measurement)
-    diff_angle    = np.arccos(inner(nor, nor_measurement)/norm(nor)/norm(nor_measurement))
-    dist = np.sqrt(diff_distance**2/pos_err**2+diff_angle**2/nor_err**2)
-    return dist
+    diff = ClosestPointTriangles(triangles,pos_measurement) - pos_measurement
+    diff_angle = np.arccos(np.clip(np.sum(normals*nor_measurement,axis=1),-1.,1.))
+    return np.sum(diff*diff,axis=1)/pos_err**2 + diff_angle**2/nor_err**2
+
+def MinimumSquaredDistanceSegments(triangles,normals,measurement,starts,pos_err,nor_err):
+    """
+    Minimum of CalculateSquaredDistanceFaces over the consecutive segments of (face, measurement) pairs
+    starting at starts, none of which may be empty. The distance to the plane of a face is a
+    lower bound of the distance to the face, so the closest points are only computed for the
+    best bound of each segment and for the pairs whose bound can still beat it.
+    @param measurement: [positions, normals], (n,3) each with one measurement per face
+    @param return:      (len(starts),) minimum squared distance of each segment
+    """
+    pos_measurement = measurement[0]
+    nor_measurement = measurement[1]
+    num_pairs = len(triangles)
+    segment = np.repeat(np.arange(len(starts)),np.diff(np.append(starts,num_pairs)))
+    angle_term = (np.arccos(np.clip(np.sum(normals*nor_measurement,axis=1),-1.,1.))/nor_err)**2
+    plane_distance = np.sum((pos_measurement-triangles[:,0])*normals,axis=1)
+    lower_bound = plane_distance**2/pos_err**2 + angle_term
+    def SquaredDistance(pairs):
+      closest_points = ClosestPointTriangles(triangles[pairs],pos_measurement[pairs])
+      diff = closest_points - pos_measurement[pairs]
+      return np.sum(diff*diff,axis=1)/pos_err**2 + angle_term[pairs]
+    # The pair with the lowest bound of each segment gives an upper bound of the minimum
+    hits = np.flatnonzero(lower_bound == np.minimum.reduceat(lower_bound,starts)[segment])
+    best = hits[np.searchsorted(segment[hits],np.arange(len(starts)))]
+    upper_bound = SquaredDistance(best)
+    pairs = np.flatnonzero(lower_bound < upper_bound[segment])
+    np.minimum.at(upper_bound,segment[pairs],SquaredDistance(pairs))
+    return upper_bound
 
 def CalculateMahaDistanceFace(face,measurement,pos_err,nor_err):
   p1,p2,p3,nor = face
-  pos_measurement = measurement[0]
-  nor_measurement = measurement[1]
-  norm = lambda x: np.linalg.norm(x)
-  inner = lambda a, b: np.inner(a,b)
-  diff_distance   = norm(inner((pos_measurement-p1), nor)/norm(nor))
-  diff_angle      = np.arccos(inner(nor, nor_measurement)/norm(nor)/norm(nor_measurement))
-  dist = np.sqrt(diff_distance**2/pos_err**2+diff_angle**2/nor_err**2)
-  return dist
+  ax,ay,az = np.asarray(p1,dtype=np.float64).tolist()
+  px,py,pz = np.asarray(measurement[0],dtype=np.float64).tolist()
+  mx,my,mz = np.asarray(measurement[1],dtype=np.float64).tolist()
+  nx,ny,nz = np.asarray(nor,dtype=np.float64).tolist()
+  nor_norm = math.sqrt(nx*nx + ny*ny + nz*nz)
+  # Distance to the plane of the face and angle between the normals
+  diff_distance = abs((px-ax)*nx + (py-ay)*ny + (pz-az)*nz)/nor_norm
+  cos_angle = (nx*mx + ny*my + nz*mz)/nor_norm/math.sqrt(mx*mx + my*my + mz*mz)
+  diff_angle = math.acos(min(1.,max(-1.,cos_angle)))
+  return math.sqrt(diff_distance**2/pos_err**2 + diff_angle**2/nor_err**2)
 
 
 def Pruning(list_particles, weights,percentage):
   assert (len(list_particles)==len(weights)),"Wrong input data, length of list of particles are not equal to length of weight"
   num_particles = len(list_particles)
-  pruned_list = []
-  new_list_p = []
-  new_list_w = []
-  c = np.zeros(num_particles)
-  c[0] = weights[0]
-  for i in range(num_particles-1):
-    c[i+1] = c[i] + weights[i+1]
-  u = np.zeros(num_particles)
-  u[0] = np.random.uniform(0,1)/num_particles
-  k = 0
-  for i in range(num_particles):
-    u[i] = u[0] + 1./num_particles*i
-    while (u[i] > c[k]):
-      k+=1
-    new_list_p.append(list_particles[k]) 
-  for i in range(num_particles):
-    if i == 0:
-      pruned_list.append(new_list_p[i])
-    else:
-      if not np.allclose(np.dot(new_list_p[i],np.linalg.inv(new_list_p[i-1])),np.eye(4)):
-        # IPython.embed()
-        pruned_list.append(new_list_p[i])
+  # Systematic resampling: the k-th source particle is the first one whose cumulative weight reaches u[i]
+  c = np.cumsum(weights)
+  u = np.random.uniform(0,1)/num_particles + np.arange(num_particles)*(1./num_particles)
+  idx = np.minimum(np.searchsorted(c,u),num_particles-1)
+  # idx is sorted, a resampled particle duplicates the previous one iff it has the same source index
+  keep = np.concatenate(([True],idx[1:] != idx[:-1]))
+  pruned_list = [list_particles[k] for k in idx[keep]]
   return pruned_list
       
 
 def Pruning_old(list_particles, weights,prune_percentage):
   assert (len(list_particles)==len(weights)),"Wrong input data, length of list of particles are not equal to length of weight"
-  pruned_list = []
-  maxweight = 0
-  for w in weights:
-    if w > maxweight:
-      maxweight = w
-  threshold = prune_percentage*maxweight
-  for i in range(len(list_particles)):
-    if weights[i] > threshold:
-      pruned_list.append(list_particles[i])
+  weights = np.asarray(weights)
+  threshold = prune_percentage*np.max(weights,initial=0.)
+  pruned_list = [list_particles[k] for k in np.flatnonzero(weights > threshold)]
   return pruned_list
 
 def Visualize(mesh,particle,D=[]):
@@ -236,6 +494,23 @@ def Volume(radius,dim):
   return (np.pi**(dim/2.))/sp.special.gamma(dim/2.+1)*(radius**dim)
 
 
+def ScalingSeriesSchedule(sigma0,sigma_desired):
+  """
+  Initial and terminal neighborhood sizes of the scaling series and its number of steps
+  @param sigma0:        6x6 initial covariance, translation block first
+  @param sigma_desired: 6x6 terminal covariance
+  @return delta_rot, delta_trans, delta_desired_rot, delta_desired_trans, N
+  """
+  delta_rot = np.max(np.linalg.cholesky(sigma0[3:,3:]).T)
+  delta_trans = np.max(np.linalg.cholesky(sigma0[:3,:3]).T)
+  delta_desired_rot = np.max(np.linalg.cholesky(sigma_desired[3:,3:]).T)
+  delta_desired_trans = np.max(np.linalg.cholesky(sigma_desired[:3,:3]).T)
+  # log2 of the ratio of the volumes of the 3-balls, Volume(r,3) = 4/3*pi*r**3
+  N_rot  = 3*np.log2(delta_rot/delta_desired_rot)
+  N_trans = 3*np.log2(delta_trans/delta_desired_trans)
+  N = int(np.round(max(N_rot,N_trans)))
+  return delta_rot,delta_trans,delta_desired_rot,delta_desired_trans,N
+
 def ScalingSeriesB(mesh,sorted_face, particles0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage = 0.6,dim = 6, visualize = False):
   """
   @type  V0:  ParticleFilterLib.Region
@@ -246,19 +521,15 @@ def ScalingSeriesB(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
   @param dim: dimension of the state space (6 DOFs)
   """ 
   zoom = 2**(-1./6.)
-  delta_rot = np.max(np.linalg.cholesky(sigma0[3:,3:]).T)
-  delta_trans = np.max(np.linalg.cholesky(sigma0[:3,:3]).T)
-  delta_desired_rot = np.max(np.linalg.cholesky(sigma_desired[3:,3:]).T)
-  delta_desired_trans = np.max(np.linalg.cholesky(sigma_desired[:3,:3]).T)
-  N_rot  = np.log2(Volume(delta_rot,3)/Volume(delta_desired_rot,3))
-  N_trans = np.log2(Volume(delta_trans,3)/Volume(delta_desired_trans,3))
-  N = int(np.round(max(N_rot,N_trans)))
+  delta_rot,delta_trans,delta_desired_rot,delta_desired_trans,N = ScalingSeriesSchedule(sigma0,sigma_desired)
   particles = particles0
   V = Region(particles,delta_rot,delta_trans)
   t1 = 0.
   t2 = 0.
   t3 = 0.
   sum_num_particles = 0
+  # The mesh does not change, index its faces once for all the iterations
+  face_tree = BuildFaceTree(mesh)
   for n in range(N):
     delta_rot = delta_rot*zoom
     delta_trans = delta_trans*zoom
@@ -268,7 +539,7 @@ def ScalingSeriesB(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
     # print "len of new generated particles ", len(particles)
     # print 'tau ', tau
     # Compute normalized weights
-    weights = ComputeNormalizedWeightsB(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau)
+    weights = ComputeNormalizedWeightsB(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau,face_tree)
     # Prune based on weights
     pruned_particles = Pruning_old(particles,weights,prune_percentage)
     # print 'No. of particles, after pruning:', len(pruned_particles)
@@ -278,7 +549,7 @@ def ScalingSeriesB(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
     #   Visualize(visualize_mesh,particles,measurements)
     sum_num_particles += len(particles)
   new_set_of_particles = EvenDensityCover(V,M)
-  new_weights = ComputeNormalizedWeightsB(mesh,sorted_face,new_set_of_particles,measurements,pos_err,nor_err,1)
+  new_weights = ComputeNormalizedWeightsB(mesh,sorted_face,new_set_of_particles,measurements,pos_err,nor_err,1,face_tree)
   return new_set_of_particles, new_weights
 
 def ScalingSeries(mesh,sorted_face, particles0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage = 0.6,dim = 6, visualize = False):
@@ -291,15 +562,11 @@ def ScalingSeries(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
   @param dim: dimension of the state space (6 DOFs)
   """ 
   zoom = 2**(-1./6.)
-  delta_rot = np.max(np.linalg.cholesky(sigma0[3:,3:]).T)
-  delta_trans = np.max(np.linalg.cholesky(sigma0[:3,:3]).T)
-  delta_desired_rot = np.max(np.linalg.cholesky(sigma_desired[3:,3:]).T)
-  delta_desired_trans = np.max(np.linalg.cholesky(sigma_desired[:3,:3]).T)
-  N_rot  = np.log2(Volume(delta_rot,3)/Volume(delta_desired_rot,3))
-  N_trans = np.log2(Volume(delta_trans,3)/Volume(delta_desired_trans,3))
-  N = int(np.round(max(N_rot,N_trans)))
+  delta_rot,delta_trans,delta_desired_rot,delta_desired_trans,N = ScalingSeriesSchedule(sigma0,sigma_desired)
   particles = particles0
   V = Region(particles,delta_rot,delta_trans)
+  # The mesh does not change, prepare its sorted faces once for all the iterations
+  prepared_face = PrepareSortedFace(mesh,sorted_face)
   for n in range(N):
     delta_rot = delta_rot*zoom
     delta_trans = delta_trans*zoom
@@ -309,7 +576,7 @@ def ScalingSeries(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
     # print "len of new generated particles ", len(particles)
     # print 'tau ', tau
     # Compute normalized weights
-    weights = ComputeNormalizedWeights(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau)
+    weights = ComputeNormalizedWeights(mesh,sorted_face,particles,measurements,pos_err,nor_err,tau,prepared_face)
     # Prune based on weights
     pruned_particles = Pruning_old(particles,weights,prune_percentage)     
     # print 'No. of particles, after pruning:', len(pruned_particles)
@@ -318,7 +585,7 @@ def ScalingSeries(mesh,sorted_face, particles0, measurements, pos_err, nor_err,
     # if visualize:
     #   Visualize(mesh,particles,measurements)
   new_set_of_particles =  EvenDensityCover(V,M)
-  new_weights = ComputeNormalizedWeights(mesh,sorted_face,new_set_of_particles,measurements,pos_err,nor_err,1)
+  new_weights = ComputeNormalizedWeights(mesh,sorted_face,new_set_of_particles,measurements,pos_err,nor_err,1,prepared_face)
   return new_set_of_particles, new_weights
 
 
@@ -366,7 +633,7 @@ def GenerateMeasurementsTriangleSampling(mesh,pos_err,nor_err,num_measurements):
   # point_errs = np.random.multivariate_normal(np.zeros(3),np.eye(3),num_measurements)
   random_vecs = np.random.uniform(-1,1,(num_measurements,3))
   point_errs = np.asarray([np.random.normal(0.,np.sqrt(3)*pos_err)*random_vec/np.linalg.norm(random_vec) for random_vec in random_vecs])
-  noisy_points = copy.deepcopy(samples) + point_errs
+  noisy_points = samples + point_errs
   noisy_normals = [np.dot(tr.rotation_matrix(np.random.normal(0.,nor_err),np.cross(np.random.uniform(-1,1,3),n))[:3,:3],n) for n in normals]
   noisy_normals = np.asarray([noisy_n/np.linalg.norm(noisy_n) for noisy_n in noisy_normals])
   dist = [np.linalg.norm(point_err) for point_err in point_errs]
@@ -381,23 +648,20 @@ def NormalHashing(obj,num_random_unit,plot_histogram):
   for k in range(num_random_unit):
     randR = tr.random_rotation_matrix()
     ref_axis = np.dot(randR[:3,:3],np.array([0.,0.,1.]))   
-    mesh = []
-    angle_dict = []
-    for i in range(len(obj.faces)):
-      n = obj.face_normals[i]
-      angle = np.arccos(np.dot(n,ref_axis))
-      angle_dict.append(angle)
-      mesh.append([i,angle])
+    angle_dict = np.arccos(np.clip(np.dot(obj.face_normals,ref_axis),-1.,1.))
     hist,bin_edges = np.histogram(angle_dict,range=(0,np.pi),density=True)
     normalized_hist = hist/np.sum(hist)
     if sp.stats.entropy(normalized_hist) > entropy: #histogram with bigger shannon entropy is selected
       entropy = sp.stats.entropy(normalized_hist)
-      sorted_dict = [sorted(mesh,key=lambda f: f[1]),ref_axis]
+      # Stable sort, faces with equal angles keep their order
+      face_idx = np.argsort(angle_dict,kind='mergesort')
+      sorted_dict = [face_idx,angle_dict[face_idx],ref_axis]
       toshow = normalized_hist,bin_edges
   # print 'Selected unit vec:',sorted_dict[1]
   # print 'Entropy:', entropy
 
   if plot_histogram:
+    import matplotlib.pyplot as plt
     fig = plt.figure()
     ax1 = fig.add_subplot(211)
     width = 0.7*(toshow[1][1] - toshow[1][0])
@@ -412,50 +676,27 @@ def NormalHashing(obj,num_random_unit,plot_histogram):
     ax2.set_title("Hist of a random unit vec")
     fig.tight_layout()
     plt.show(True)
-  face_idx = [sorted_dict[0][i][0] for i in range(len(sorted_dict[0]))]
-  angle_list = [sorted_dict[0][i][1] for i in range(len(sorted_dict[0]))]
-  mesh_w_sorted_dict = [face_idx,angle_list,sorted_dict[1]]
-  return mesh_w_sorted_dict # A list [[sorted_face_idx,angle],ref_axis]
+  return sorted_dict # A list [sorted_face_idx,sorted_angle,ref_axis]
 
 def RunImprovedScalingSeries(mesh,sorted_face, ptcls0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage,dim = 6, visualize = False):
    list_particles, weights = ScalingSeries(mesh,sorted_face, ptcls0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage,dim = 6, visualize = False) 
-   maxweight = weights[0]
-   for w in weights:
-     if w > maxweight:
-       maxweight = w   
-   acum_weight = 0
-   acum_vec = np.zeros(6)
-   weight_threshold = 0.7*maxweight
-   for i in range(len(list_particles)):
-     if weights[i] > weight_threshold:
-       p = SE3.TranToVec(list_particles[i])
-       acum_vec += p*weights[i]
-       acum_weight += weights[i]
-   estimated_particle = acum_vec*(1./acum_weight)
+   weights = np.asarray(weights)
+   selected = np.flatnonzero(weights > 0.7*np.max(weights))
+   vecs = np.array([SE3.TranToVec(list_particles[i]) for i in selected]).reshape(-1,6)
+   estimated_particle = np.dot(normalize(weights[selected]),vecs)
    return SE3.VecToTran(estimated_particle)
 
 def RunScalingSeries(mesh,sorted_face, ptcls0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage,dim = 6, visualize = False):
    list_particles, weights = ScalingSeriesB(mesh,sorted_face, ptcls0, measurements, pos_err, nor_err, M, sigma0, sigma_desired, prune_percentage,dim = 6, visualize = False) 
-   maxweight = weights[0]
-   for w in weights:
-     if w > maxweight:
-       maxweight = w   
-   acum_weight = 0
-   acum_vec = np.zeros(6)
-   weight_threshold = 0.7*maxweight
-   for i in range(len(list_particles)):
-     if weights[i] > weight_threshold:
-       p = SE3.TranToVec(list_particles[i])
-       acum_vec += p*weights[i]
-       acum_weight += weights[i]
-   estimated_particle = acum_vec*(1./acum_weight)
+   weights = np.asarray(weights)
+   selected = np.flatnonzero(weights > 0.7*np.max(weights))
+   vecs = np.array([SE3.TranToVec(list_particles[i]) for i in selected]).reshape(-1,6)
+   estimated_particle = np.dot(normalize(weights[selected]),vecs)
    return SE3.VecToTran(estimated_particle)
 
 def MeasurementFitHypothesis(hypothesis,measurement,pos_err,nor_err,mesh,sorted_face,distance_threshold):
-  d = copy.deepcopy(measurement)
-  T_inv = np.linalg.inv(hypothesis)
-  d[0] = np.dot(T_inv[:3,:3],d[0]) + T_inv[:3,3]
-  d[1] = np.dot(T_inv[:3,:3],d[1])
+  positions_t,normals_t = TransformMeasurements([hypothesis],[measurement])
+  d = [positions_t[0,0],normals_t[0,0]]
   dist = FindminimumDistanceMeshOriginal(mesh,sorted_face,d,pos_err,nor_err)
   if dist < distance_threshold:
     return True
@@ -463,13 +704,8 @@ def MeasurementFitHypothesis(hypothesis,measurement,pos_err,nor_err,mesh,sorted_
     return False
 
 def ScoreHypothesis(hypothesis,measurements,pos_err,nor_err,mesh,sorted_face):
-  data = copy.deepcopy(measurements)
-  T_inv = np.linalg.inv(hypothesis)
-  dist = 0.
-  for d in data:
-    d[0] = np.dot(T_inv[:3,:3],d[0]) + T_inv[:3,3]
-    d[1] = np.dot(T_inv[:3,:3],d[1])
-  dist = sum([FindminimumDistanceMeshOriginal(mesh,sorted_face,d,pos_err,nor_err) for d in data])
+  positions_t,normals_t = TransformMeasurements([hypothesis],measurements)
+  dist = np.sum(FindminimumDistancesMeshOriginal(mesh,positions_t[0],normals_t[0],pos_err,nor_err))
   score = dist/len(measurements)
   return score
 
@@ -72,7 +72,10 @@ of the transformation matrix, i.e. M[:3, 3].
 The transpose of the transformation matrices may have to be used to interface
 with other graphics systems, e.g. with OpenGL's glMultMatrixd(). See also [16].
 
-Calculations are carried out with numpy.float64 precision.
+Calculations are carried out with numpy.float64 precision. The matrix
+constructors accept a dtype argument to return the result in another
+precision, e.g. numpy.float32 for upload to graphics APIs. These constructors
+are not replaced by the compiled transformations.c implementations.
 
 Vector, point, quaternion, and matrix function arguments are expected to be
 "array like", i.e. tuple, list, or numpy arrays.
@@ -197,6 +200,11 @@ import math
 
 import numpy
 
+try:
+    from scipy.linalg import svd as _scipy_svd
+except ImportError:
+    _scipy_svd = None
+
 __version__ = '2015.07.18'
 __docformat__ = 'restructuredtext en'
 __all__ = ()
@@ -214,10 +222,10 @@ def identity_matrix():
     True
 
     """
-    return numpy.identity(4)
+    return _IDENTITY.copy()
 
 
-def translation_matrix(direction):
+def translation_matrix(direction, dtype=numpy.float64):
     """Return matrix to translate by direction vector.
 
     >>> v = numpy.random.random(3) - 0.5
@@ -225,7 +233,7 @@ def translation_matrix(direction):
     True
 
     """
-    M = numpy.identity(4)
+    M = _IDENTITY.astype(dtype)
     M[:3, 3] = direction[:3]
     return M
 
@@ -239,10 +247,10 @@ def translation_from_matrix(matrix):
     True
 
     """
-    return numpy.array(matrix, copy=False)[:3, 3].copy()
+    return numpy.asarray(matrix)[:3, 3].copy()
 
 
-def reflection_matrix(point, normal):
+def reflection_matrix(point, normal, dtype=numpy.float64):
     """Return matrix to mirror at plane defined by point and normal vector.
 
     >>> v0 = numpy.random.random(4) - 0.5
@@ -261,11 +269,13 @@ def reflection_matrix(point, normal):
     True
 
     """
-    normal = unit_vector(normal[:3])
-    M = numpy.identity(4)
-    M[:3, :3] -= 2.0 * numpy.outer(normal, normal)
-    M[:3, 3] = (2.0 * numpy.dot(point[:3], normal)) * normal
-    return M
+    x, y, z = _unit_vector3(normal)
+    x2, y2, z2 = 2.0*x, 2.0*y, 2.0*z
+    t = point[0]*x + point[1]*y + point[2]*z
+    return numpy.array([[1.0 - x2*x, -x2*y, -x2*z, t*x2],
+                        [-y2*x, 1.0 - y2*y, -y2*z, t*y2],
+                        [-z2*x, -z2*y, 1.0 - z2*z, t*z2],
+                        [0.0, 0.0, 0.0, 1.0]], dtype)
 
 
 def reflection_from_matrix(matrix):
@@ -278,26 +288,31 @@ def reflection_from_matrix(matrix):
     >>> M1 = reflection_matrix(point, normal)
     >>> is_same_transform(M0, M1)
     True
+    >>> reflection_from_matrix(rotation_matrix(math.pi/2, [0, 0, 1]))
+    Traceback (most recent call last):
+     ...
+    ValueError: matrix is not a reflection matrix
 
     """
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)
-    # normal: unit eigenvector corresponding to eigenvalue -1
-    w, V = numpy.linalg.eig(M[:3, :3])
-    i = numpy.where(abs(numpy.real(w) + 1.0) < 1e-8)[0]
-    if not len(i):
+    M = numpy.asarray(matrix, dtype=numpy.float64)
+    if abs(M[0, 0] + M[1, 1] + M[2, 2] - 1.0) > 1e-8:
         raise ValueError("no unit eigenvector corresponding to eigenvalue -1")
-    normal = numpy.real(V[:, i[0]]).squeeze()
-    # point: any unit eigenvector corresponding to eigenvalue 1
-    w, V = numpy.linalg.eig(M)
-    i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-8)[0]
-    if not len(i):
-        raise ValueError("no unit eigenvector corresponding to eigenvalue 1")
-    point = numpy.real(V[:, i[-1]]).squeeze()
-    point /= point[3]
+    # normal: largest column of I - M33, which equals 2*outer(normal, normal)
+    A = numpy.identity(3) - M[:3, :3]
+    normal = A[:, numpy.argmax(numpy.sum(A*A, axis=0))]
+    normal = normal / math.sqrt(numpy.dot(normal, normal))
+    # the translation 2*dot(point, normal)*normal is parallel to the normal
+    t = M[:3, 3]
+    if (numpy.any(abs(A - 2.0 * numpy.outer(normal, normal)) > 1e-6) or
+            numpy.any(abs(t - numpy.dot(t, normal) * normal) > 1e-6)):
+        raise ValueError("matrix is not a reflection matrix")
+    # point: midpoint between origin and its mirror image
+    point = numpy.array([0.0, 0.0, 0.0, 1.0])
+    point[:3] = t / 2.0
     return point, normal
 
 
-def rotation_matrix(angle, direction, point=None):
+def rotation_matrix(angle, direction, point=None, dtype=numpy.float64):
     """Return matrix to rotate about axis defined by point and direction.
 
     >>> R = rotation_matrix(math.pi/2, [0, 0, 1], [1, 0, 0])
@@ -320,25 +335,88 @@ def rotation_matrix(angle, direction, point=None):
     >>> numpy.allclose(2, numpy.trace(rotation_matrix(math.pi/2,
     ...                                               direc, point)))
     True
+    >>> R = rotation_matrix(angle, direc, point, dtype=numpy.float32)
+    >>> R.dtype == numpy.float32
+    True
+    >>> numpy.allclose(R, R0, atol=1e-6)
+    True
 
     """
     sina = math.sin(angle)
     cosa = math.cos(angle)
-    direction = unit_vector(direction[:3])
+    x, y, z = _unit_vector3(direction)
     # rotation matrix around unit vector
-    R = numpy.diag([cosa, cosa, cosa])
-    R += numpy.outer(direction, direction) * (1.0 - cosa)
-    direction *= sina
-    R += numpy.array([[ 0.0,         -direction[2],  direction[1]],
-                      [ direction[2], 0.0,          -direction[0]],
-                      [-direction[1], direction[0],  0.0]])
-    M = numpy.identity(4)
-    M[:3, :3] = R
-    if point is not None:
+    c = 1.0 - cosa
+    xc, yc, zc = x*c, y*c, z*c
+    xs, ys, zs = x*sina, y*sina, z*sina
+    r00, r01, r02 = cosa + x*xc, y*xc - zs, z*xc + ys
+    r10, r11, r12 = x*yc + zs, cosa + y*yc, z*yc - xs
+    r20, r21, r22 = x*zc - ys, y*zc + xs, cosa + z*zc
+    if point is None:
+        t0 = t1 = t2 = 0.0
+    else:
         # rotation not around origin
-        point = numpy.array(point[:3], dtype=numpy.float64, copy=False)
-        M[:3, 3] = point - numpy.dot(R, point)
-    return M
+        px, py, pz = [float(v) for v in point[:3]]
+        t0 = px - (r00*px + r01*py + r02*pz)
+        t1 = py - (r10*px + r11*py + r12*pz)
+        t2 = pz - (r20*px + r21*py + r22*pz)
+    return numpy.array([[r00, r01, r02, t0],
+                        [r10, r11, r12, t1],
+                        [r20, r21, r22, t2],
+                        [0.0, 0.0, 0.0, 1.0]], dtype)
+
+
+def rotation_matrices(angle, direction, point=None, dtype=numpy.float64):
+    """Return stack of matrices to rotate about axes defined by points and
+    directions.
+
+    The angles, directions and points are broadcast against each other
+    along the first axis.
+
+    >>> angles = (numpy.random.random(5) - 0.5) * (2*math.pi)
+    >>> direcs = numpy.random.random((5, 3)) - 0.5
+    >>> points = numpy.random.random((5, 3)) - 0.5
+    >>> R = rotation_matrices(angles, direcs, points)
+    >>> R.shape
+    (5, 4, 4)
+    >>> all(is_same_transform(R[i], rotation_matrix(angles[i], direcs[i],
+    ...                                             points[i]))
+    ...     for i in range(5))
+    True
+    >>> R = rotation_matrices(angles, [0, 0, 1])
+    >>> numpy.allclose(R[:, 2, 2], 1)
+    True
+
+    """
+    angle = numpy.array(angle, dtype=numpy.float64, ndmin=1)
+    direction = numpy.array(direction, dtype=numpy.float64, ndmin=2)[:, :3]
+    direction = unit_vector(direction, axis=1)
+    n = max(len(angle), len(direction))
+    sina = numpy.sin(angle)
+    cosa = numpy.cos(angle)
+    x, y, z = direction.T
+    # rotation matrices around unit vectors
+    c = 1.0 - cosa
+    xc, yc, zc = x*c, y*c, z*c
+    xs, ys, zs = x*sina, y*sina, z*sina
+    M = numpy.zeros((n, 4, 4))
+    R = M[:, :3, :3]
+    R[:, 0, 0] = cosa + x*xc
+    R[:, 0, 1] = y*xc - zs
+    R[:, 0, 2] = z*xc + ys
+    R[:, 1, 0] = x*yc + zs
+    R[:, 1, 1] = cosa + y*yc
+    R[:, 1, 2] = z*yc - xs
+    R[:, 2, 0] = x*zc - ys
+    R[:, 2, 1] = y*zc + xs
+    R[:, 2, 2] = cosa + z*zc
+    M[:, 3, 3] = 1.0
+    if point is not None:
+        # rotations not around origin
+        point = numpy.array(point, dtype=numpy.float64, ndmin=2)[:, :3]
+        point = numpy.broadcast_to(point, (n, 3))
+        M[:, :3, 3] = point - numpy.einsum('nij,nj->ni', R, point)
+    return M.astype(dtype, copy=False)
 
 
 def rotation_from_matrix(matrix):
@@ -352,36 +430,64 @@ def rotation_from_matrix(matrix):
     >>> R1 = rotation_matrix(angle, direc, point)
     >>> is_same_transform(R0, R1)
     True
+    >>> rotation_from_matrix(scale_matrix(0.5))
+    Traceback (most recent call last):
+     ...
+    ValueError: matrix is not a rotation matrix
 
     """
-    R = numpy.array(matrix, dtype=numpy.float64, copy=False)
+    R = numpy.asarray(matrix, dtype=numpy.float64)
     R33 = R[:3, :3]
-    # direction: unit eigenvector of R33 corresponding to eigenvalue of 1
-    w, W = numpy.linalg.eig(R33.T)
-    i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-8)[0]
-    if not len(i):
-        raise ValueError("no unit eigenvector corresponding to eigenvalue 1")
-    direction = numpy.real(W[:, i[-1]]).squeeze()
-    # point: unit eigenvector of R33 corresponding to eigenvalue of 1
-    w, Q = numpy.linalg.eig(R)
-    i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-8)[0]
-    if not len(i):
-        raise ValueError("no unit eigenvector corresponding to eigenvalue 1")
-    point = numpy.real(Q[:, i[-1]]).squeeze()
-    point /= point[3]
-    # rotation angle depending on direction
-    cosa = (numpy.trace(R33) - 1.0) / 2.0
-    if abs(direction[2]) > 1e-8:
-        sina = (R[1, 0] + (cosa-1.0)*direction[0]*direction[1]) / direction[2]
-    elif abs(direction[1]) > 1e-8:
-        sina = (R[0, 2] + (cosa-1.0)*direction[0]*direction[2]) / direction[1]
+    cosa = (R33[0, 0] + R33[1, 1] + R33[2, 2] - 1.0) / 2.0
+    if abs(cosa) > 1.0 + 1e-8:
+        raise ValueError("matrix is not a rotation matrix")
+    cosa = min(max(cosa, -1.0), 1.0)
+    # direction: axis of the skew-symmetric part, scaled by 2*sin(angle)
+    axis = numpy.array([R[2, 1] - R[1, 2],
+                        R[0, 2] - R[2, 0],
+                        R[1, 0] - R[0, 1]])
+    sina = math.sqrt(numpy.dot(axis, axis)) / 2.0
+    if cosa < 0.0:
+        # near 180 degrees the symmetric part (1-cosa)*outer(d, d) is better
+        # conditioned; take its largest column and the sign from the axis
+        S = (R33 + R33.T) / 2.0
+        S[[0, 1, 2], [0, 1, 2]] -= cosa
+        direction = S[:, numpy.argmax(numpy.sum(S*S, axis=0))]
+        direction /= math.sqrt(numpy.dot(direction, direction))
+        if numpy.dot(direction, axis) < 0.0:
+            direction *= -1.0
+    elif sina > 1e-8:
+        direction = axis / (2.0 * sina)
     else:
-        sina = (R[2, 1] + (cosa-1.0)*direction[1]*direction[2]) / direction[0]
+        # identity rotation, any axis will do
+        direction = numpy.array([0.0, 0.0, 1.0])
+        sina = 0.0
     angle = math.atan2(sina, cosa)
+    # the closed form above holds only for rotations: R33 must be rebuilt
+    # from angle and direction, and the translation of a rotation about a
+    # point has no component along the axis
+    t = R[:3, 3]
+    if cosa < 1.0 - 1e-12:
+        axial = numpy.dot(t, direction)
+    else:
+        axial = math.sqrt(numpy.dot(t, t))
+    if (abs(axial) > 1e-6 or numpy.any(
+            abs(R33 - rotation_matrix(angle, direction)[:3, :3]) > 1e-6)):
+        raise ValueError("matrix is not a rotation matrix")
+    # point: point on axis closest to origin, solving (I - R33) p = t in the
+    # plane perpendicular to direction
+    point = numpy.array([0.0, 0.0, 0.0, 1.0])
+    if cosa < 1.0 - 1e-12:
+        x, y, z = direction
+        t = t - axial * direction
+        cot = sina / (1.0 - cosa)
+        point[0] = (t[0] + (y*t[2] - z*t[1]) * cot) / 2.0
+        point[1] = (t[1] + (z*t[0] - x*t[2]) * cot) / 2.0
+        point[2] = (t[2] + (x*t[1] - y*t[0]) * cot) / 2.0
     return angle, direction, point
 
 
-def scale_matrix(factor, origin=None, direction=None):
+def scale_matrix(factor, origin=None, direction=None, dtype=numpy.float64):
     """Return matrix to scale by factor around origin in direction.
 
     Use factor -1 for point symmetry.
@@ -400,18 +506,28 @@ def scale_matrix(factor, origin=None, direction=None):
     """
     if direction is None:
         # uniform scaling
-        M = numpy.diag([factor, factor, factor, 1.0])
-        if origin is not None:
-            M[:3, 3] = origin[:3]
-            M[:3, 3] *= 1.0 - factor
+        if origin is None:
+            x = y = z = 0.0
+        else:
+            t = 1.0 - factor
+            x, y, z = origin[0]*t, origin[1]*t, origin[2]*t
+        M = numpy.array([[factor, 0.0, 0.0, x],
+                         [0.0, factor, 0.0, y],
+                         [0.0, 0.0, factor, z],
+                         [0.0, 0.0, 0.0, 1.0]], dtype)
     else:
         # nonuniform scaling
-        direction = unit_vector(direction[:3])
+        x, y, z = _unit_vector3(direction)
         factor = 1.0 - factor
-        M = numpy.identity(4)
-        M[:3, :3] -= factor * numpy.outer(direction, direction)
-        if origin is not None:
-            M[:3, 3] = (factor * numpy.dot(origin[:3], direction)) * direction
+        xf, yf, zf = x*factor, y*factor, z*factor
+        if origin is None:
+            t = 0.0
+        else:
+            t = xf*origin[0] + yf*origin[1] + zf*origin[2]
+        M = numpy.array([[1.0 - x*xf, -y*xf, -z*xf, t*x],
+                         [-x*yf, 1.0 - y*yf, -z*yf, t*y],
+                         [-x*zf, -y*zf, 1.0 - z*zf, t*z],
+                         [0.0, 0.0, 0.0, 1.0]], dtype)
     return M
 
 
@@ -433,8 +549,17 @@ def scale_from_matrix(matrix):
     True
 
     """
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)
+    M = numpy.asarray(matrix, dtype=numpy.float64)
     M33 = M[:3, :3]
+    factor = (M33[0, 0] + M33[1, 1] + M33[2, 2]) / 3.0
+    if numpy.all(abs(M33 - numpy.diag([factor, factor, factor])) < 1e-8):
+        # uniform scaling: origin follows from M[:3, 3] = (1-factor)*origin
+        origin = numpy.array([0.0, 0.0, 0.0, 1.0])
+        if abs(1.0 - factor) > 1e-8:
+            origin[:3] = M[:3, 3] / (1.0 - factor)
+            return factor, origin, None
+        elif not numpy.any(abs(M[:3, 3]) > 1e-8):
+            return factor, origin, None
     factor = numpy.trace(M33) - 2.0
     try:
         # direction: unit eigenvector corresponding to eigenvalue factor
@@ -457,7 +582,7 @@ def scale_from_matrix(matrix):
 
 
 def projection_matrix(point, normal, direction=None,
-                      perspective=None, pseudo=False):
+                      perspective=None, pseudo=False, dtype=numpy.float64):
     """Return matrix to project onto plane defined by point and normal.
 
     Using either perspective point, projection direction, or none of both.
@@ -488,34 +613,37 @@ def projection_matrix(point, normal, direction=None,
     True
 
     """
-    M = numpy.identity(4)
-    point = numpy.array(point[:3], dtype=numpy.float64, copy=False)
-    normal = unit_vector(normal[:3])
+    # all three projections are of the form
+    # M[:3, :3] = a*I - outer(u, normal), M[:3, 3] = dot(point, normal)*u
+    nx, ny, nz = n = _unit_vector3(normal)
+    px, py, pz = [float(v) for v in point[:3]]
+    pn = px*nx + py*ny + pz*nz
+    w = [0.0, 0.0, 0.0, 1.0]
     if perspective is not None:
         # perspective projection
-        perspective = numpy.array(perspective[:3], dtype=numpy.float64,
-                                  copy=False)
-        M[0, 0] = M[1, 1] = M[2, 2] = numpy.dot(perspective-point, normal)
-        M[:3, :3] -= numpy.outer(perspective, normal)
+        ux, uy, uz = [float(v) for v in perspective[:3]]
+        un = ux*nx + uy*ny + uz*nz
+        a = un - pn
+        w = [-nx, -ny, -nz, un]
         if pseudo:
             # preserve relative depth
-            M[:3, :3] -= numpy.outer(normal, normal)
-            M[:3, 3] = numpy.dot(point, normal) * (perspective+normal)
-        else:
-            M[:3, 3] = numpy.dot(point, normal) * perspective
-        M[3, :3] = -normal
-        M[3, 3] = numpy.dot(perspective, normal)
+            ux += nx
+            uy += ny
+            uz += nz
     elif direction is not None:
         # parallel projection
-        direction = numpy.array(direction[:3], dtype=numpy.float64, copy=False)
-        scale = numpy.dot(direction, normal)
-        M[:3, :3] -= numpy.outer(direction, normal) / scale
-        M[:3, 3] = direction * (numpy.dot(point, normal) / scale)
+        ux, uy, uz = [float(v) for v in direction[:3]]
+        scale = ux*nx + uy*ny + uz*nz
+        ux, uy, uz = ux / scale, uy / scale, uz / scale
+        a = 1.0
     else:
         # orthogonal projection
-        M[:3, :3] -= numpy.outer(normal, normal)
-        M[:3, 3] = numpy.dot(point, normal) * normal
-    return M
+        ux, uy, uz = n
+        a = 1.0
+    return numpy.array([[a - ux*nx, -ux*ny, -ux*nz, pn*ux],
+                        [-uy*nx, a - uy*ny, -uy*nz, pn*uy],
+                        [-uz*nx, -uz*ny, a - uz*nz, pn*uz],
+                        w], dtype)
 
 
 def projection_from_matrix(matrix, pseudo=False):
@@ -550,7 +678,7 @@ def projection_from_matrix(matrix, pseudo=False):
     True
 
     """
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)
+    M = numpy.asarray(matrix, dtype=numpy.float64)
     M33 = M[:3, :3]
     w, V = numpy.linalg.eig(M)
     i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-8)[0]
@@ -591,7 +719,8 @@ def projection_from_matrix(matrix, pseudo=False):
         return point, normal, None, perspective, pseudo
 
 
-def clip_matrix(left, right, bottom, top, near, far, perspective=False):
+def clip_matrix(left, right, bottom, top, near, far, perspective=False,
+                dtype=numpy.float64):
     """Return matrix to obtain normalized device coordinates from frustum.
 
     The frustum bounds are axis-aligned along x (left, right),
@@ -627,23 +756,33 @@ def clip_matrix(left, right, bottom, top, near, far, perspective=False):
     """
     if left >= right or bottom >= top or near >= far:
         raise ValueError("invalid frustum")
+    if perspective and near <= _EPS:
+        raise ValueError("invalid frustum: near <= 0")
+    M = numpy.zeros((4, 4), dtype)
+    rl = 1.0 / (right-left)
+    tb = 1.0 / (top-bottom)
+    fn = 1.0 / (far-near)
     if perspective:
-        if near <= _EPS:
-            raise ValueError("invalid frustum: near <= 0")
         t = 2.0 * near
-        M = [[t/(left-right), 0.0, (right+left)/(right-left), 0.0],
-             [0.0, t/(bottom-top), (top+bottom)/(top-bottom), 0.0],
-             [0.0, 0.0, (far+near)/(near-far), t*far/(far-near)],
-             [0.0, 0.0, -1.0, 0.0]]
+        M[0, 0] = -t * rl
+        M[0, 2] = (right+left) * rl
+        M[1, 1] = -t * tb
+        M[1, 2] = (top+bottom) * tb
+        M[2, 2] = -(far+near) * fn
+        M[2, 3] = t * far * fn
+        M[3, 2] = -1.0
     else:
-        M = [[2.0/(right-left), 0.0, 0.0, (right+left)/(left-right)],
-             [0.0, 2.0/(top-bottom), 0.0, (top+bottom)/(bottom-top)],
-             [0.0, 0.0, 2.0/(far-near), (far+near)/(near-far)],
-             [0.0, 0.0, 0.0, 1.0]]
-    return numpy.array(M)
+        M[0, 0] = 2.0 * rl
+        M[0, 3] = -(right+left) * rl
+        M[1, 1] = 2.0 * tb
+        M[1, 3] = -(top+bottom) * tb
+        M[2, 2] = 2.0 * fn
+        M[2, 3] = -(far+near) * fn
+        M[3, 3] = 1.0
+    return M
 
 
-def shear_matrix(angle, direction, point, normal):
+def shear_matrix(angle, direction, point, normal, dtype=numpy.float64):
     """Return matrix to shear by angle along direction vector on shear plane.
 
     The shear plane is defined by a point and normal vector. The direction
@@ -663,15 +802,17 @@ def shear_matrix(angle, direction, point, normal):
     True
 
     """
-    normal = unit_vector(normal[:3])
-    direction = unit_vector(direction[:3])
-    if abs(numpy.dot(normal, direction)) > 1e-6:
+    nx, ny, nz = _unit_vector3(normal)
+    x, y, z = _unit_vector3(direction)
+    if abs(nx*x + ny*y + nz*z) > 1e-6:
         raise ValueError("direction and normal vectors are not orthogonal")
     angle = math.tan(angle)
-    M = numpy.identity(4)
-    M[:3, :3] += angle * numpy.outer(direction, normal)
-    M[:3, 3] = -angle * numpy.dot(point[:3], normal) * direction
-    return M
+    xa, ya, za = x*angle, y*angle, z*angle
+    t = -(point[0]*nx + point[1]*ny + point[2]*nz)
+    return numpy.array([[1.0 + xa*nx, xa*ny, xa*nz, t*xa],
+                        [ya*nx, 1.0 + ya*ny, ya*nz, t*ya],
+                        [za*nx, za*ny, 1.0 + za*nz, t*za],
+                        [0.0, 0.0, 0.0, 1.0]], dtype)
 
 
 def shear_from_matrix(matrix):
@@ -688,34 +829,25 @@ def shear_from_matrix(matrix):
     True
 
     """
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)
+    M = numpy.asarray(matrix, dtype=numpy.float64)
     M33 = M[:3, :3]
-    # normal: cross independent eigenvectors corresponding to the eigenvalue 1
-    w, V = numpy.linalg.eig(M33)
-    i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-4)[0]
-    if len(i) < 2:
-        raise ValueError("no two linear independent eigenvectors found %s" % w)
-    V = numpy.real(V[:, i]).squeeze().T
-    lenorm = -1.0
-    for i0, i1 in ((0, 1), (0, 2), (1, 2)):
-        n = numpy.cross(V[i0], V[i1])
-        w = vector_norm(n)
-        if w > lenorm:
-            lenorm = w
-            normal = n
-    normal /= lenorm
+    # M33 - I equals tan(angle) * outer(direction, normal), a rank one
+    # matrix whose largest row is parallel to the normal
+    A = M33 - numpy.identity(3)
+    normal = A[numpy.argmax(numpy.sum(A*A, axis=1))]
+    normal = normal / vector_norm(normal)
     # direction and angle
-    direction = numpy.dot(M33 - numpy.identity(3), normal)
+    direction = numpy.dot(A, normal)
     angle = vector_norm(direction)
     direction /= angle
+    if (abs(numpy.dot(direction, normal)) > 1e-6 or
+            numpy.any(abs(A - numpy.outer(direction * angle, normal)) > 1e-6)):
+        raise ValueError("matrix is not a shear matrix")
+    # point: point on shear plane closest to origin, from
+    # M[:3, 3] = -tan(angle) * dot(point, normal) * direction
+    point = numpy.array([0.0, 0.0, 0.0, 1.0])
+    point[:3] = normal * (-numpy.dot(M[:3, 3], direction) / angle)
     angle = math.atan(angle)
-    # point: eigenvector corresponding to eigenvalue 1
-    w, V = numpy.linalg.eig(M)
-    i = numpy.where(abs(numpy.real(w) - 1.0) < 1e-8)[0]
-    if not len(i):
-        raise ValueError("no eigenvector corresponding to eigenvalue 1")
-    point = numpy.real(V[:, i[-1]]).squeeze()
-    point /= point[3]
     return angle, direction, point, normal
 
 
@@ -754,9 +886,14 @@ def decompose_matrix(matrix):
     if abs(M[3, 3]) < _EPS:
         raise ValueError("M[3, 3] is zero")
     M /= M[3, 3]
-    P = M.copy()
-    P[:, 3] = 0.0, 0.0, 0.0, 1.0
-    if not numpy.linalg.det(P):
+    # P = M with last column (0, 0, 0, 1) has the determinant of M[:3, :3];
+    # its cofactors give the inverse of P.T in closed form
+    (a, b, c), (d, e, f), (g, h, i) = M[:3, :3].tolist()
+    C = [[e*i - f*h, f*g - d*i, d*h - e*g],
+         [c*h - b*i, a*i - c*g, b*g - a*h],
+         [b*f - c*e, c*d - a*f, a*e - b*d]]
+    det = a*C[0][0] + b*C[0][1] + c*C[0][2]
+    if not det:
         raise ValueError("matrix is singular")
 
     scale = numpy.zeros((3, ))
@@ -764,15 +901,17 @@ def decompose_matrix(matrix):
     angles = [0.0, 0.0, 0.0]
 
     if any(abs(M[:3, 3]) > _EPS):
-        perspective = numpy.dot(M[:, 3], numpy.linalg.inv(P.T))
-        M[:, 3] = 0.0, 0.0, 0.0, 1.0
+        # dot(M[:, 3], inv(P.T)) for P.T = [[M33.T, M[3, :3]], [0, 1]]
+        perspective = numpy.empty((4, ))
+        perspective[:3] = numpy.dot(M[:3, 3], C) / det
+        perspective[3] = M[3, 3] - numpy.dot(perspective[:3], M[3, :3])
     else:
         perspective = numpy.array([0.0, 0.0, 0.0, 1.0])
 
     translate = M[3, :3].copy()
-    M[3, :3] = 0.0
 
-    row = M[:3, :3].copy()
+    # M is a private copy, so the rows are orthonormalized in place
+    row = M[:3, :3]
     scale[0] = vector_norm(row[0])
     row[0] /= scale[0]
     shear[0] = numpy.dot(row[0], row[1])
@@ -788,9 +927,12 @@ def decompose_matrix(matrix):
     row[2] /= scale[2]
     shear[1:] /= scale[2]
 
-    if numpy.dot(row[0], numpy.cross(row[1], row[2])) < 0:
-        numpy.negative(scale, scale)
-        numpy.negative(row, row)
+    det = (row[0, 0] * (row[1, 1]*row[2, 2] - row[1, 2]*row[2, 1]) -
+           row[0, 1] * (row[1, 0]*row[2, 2] - row[1, 2]*row[2, 0]) +
+           row[0, 2] * (row[1, 0]*row[2, 1] - row[1, 1]*row[2, 0]))
+    sign = 1.0 - 2.0 * (det < 0.0)
+    scale *= sign
+    row *= sign
 
     angles[1] = math.asin(-row[0, 2])
     if math.cos(angles[1]):
@@ -804,6 +946,100 @@ def decompose_matrix(matrix):
     return scale, shear, angles, translate, perspective
 
 
+def decompose_matrices(matrices):
+    """Return sequences of transformations from stack of transformation
+    matrices.
+
+    Batched version of decompose_matrix for arrays of shape (N, 4, 4).
+    Return tuple of arrays scale, shear, angles, translate of shape (N, 3)
+    and perspective of shape (N, 4).
+
+    Raise ValueError if any matrix is of wrong type or degenerative.
+
+    >>> M = numpy.array([compose_matrix(*(numpy.random.random((5, 4)) - 0.5))
+    ...                  for i in range(8)])
+    >>> result = decompose_matrices(M)
+    >>> result[0].shape, result[4].shape
+    ((8, 3), (8, 4))
+    >>> all(numpy.allclose(numpy.hstack(decompose_matrix(M[i])),
+    ...                    numpy.hstack([r[i] for r in result]))
+    ...     for i in range(8))
+    True
+    >>> scale, shear, angles, trans, persp = decompose_matrices(
+    ...     [euler_matrix(1, 2, 3), translation_matrix([1, 2, 3])])
+    >>> numpy.allclose(euler_matrix(*angles[0]), euler_matrix(1, 2, 3))
+    True
+    >>> numpy.allclose(trans[1], [1, 2, 3])
+    True
+
+    """
+    M = numpy.array(matrices, dtype=numpy.float64, copy=True)
+    M = M.transpose(0, 2, 1)
+    if numpy.any(abs(M[:, 3, 3]) < _EPS):
+        raise ValueError("M[3, 3] is zero")
+    M /= M[:, 3:, 3:]
+    row0, row1, row2 = M[:, 0, :3], M[:, 1, :3], M[:, 2, :3]
+    if not numpy.all(numpy.einsum('ni,ni->n', row0, numpy.cross(row1, row2))):
+        raise ValueError("matrix is singular")
+
+    n = len(M)
+    scale = numpy.zeros((n, 3))
+    shear = numpy.zeros((n, 3))
+    angles = numpy.zeros((n, 3))
+
+    perspective = numpy.zeros((n, 4))
+    perspective[:, 3] = 1.0
+    i = numpy.any(abs(M[:, :3, 3]) > _EPS, axis=1)
+    if numpy.any(i):
+        # solve P * perspective = M[:, 3] instead of inverting P.T
+        P = M[i]
+        P[:, :, 3] = 0.0, 0.0, 0.0, 1.0
+        perspective[i] = numpy.linalg.solve(P, M[i, :, 3, None])[..., 0]
+        M[i, :, 3] = 0.0, 0.0, 0.0, 1.0
+
+    translate = M[:, 3, :3].copy()
+
+    # decompose the rows in blocks that stay in cache across all steps
+    row = M[:, :3, :3].copy()
+    for i in range(0, n, _DECOMPOSE_BLOCK):
+        j = slice(i, i + _DECOMPOSE_BLOCK)
+        _decompose_rows(row[j], scale[j], shear[j], angles[j])
+
+    return scale, shear, angles, translate, perspective
+
+
+def _decompose_rows(row, scale, shear, angles):
+    """Orthonormalize stack of 3x3 rows in place and store scale, shear and
+    Euler angles into the output arrays."""
+    row0, row1, row2 = row[:, 0], row[:, 1], row[:, 2]
+    scale[:, 0] = numpy.sqrt(numpy.einsum('ni,ni->n', row0, row0))
+    row0 /= scale[:, 0, numpy.newaxis]
+    shear[:, 0] = numpy.einsum('ni,ni->n', row0, row1)
+    row1 -= row0 * shear[:, 0, numpy.newaxis]
+    scale[:, 1] = numpy.sqrt(numpy.einsum('ni,ni->n', row1, row1))
+    row1 /= scale[:, 1, numpy.newaxis]
+    shear[:, 0] /= scale[:, 1]
+    shear[:, 1] = numpy.einsum('ni,ni->n', row0, row2)
+    row2 -= row0 * shear[:, 1, numpy.newaxis]
+    shear[:, 2] = numpy.einsum('ni,ni->n', row1, row2)
+    row2 -= row1 * shear[:, 2, numpy.newaxis]
+    scale[:, 2] = numpy.sqrt(numpy.einsum('ni,ni->n', row2, row2))
+    row2 /= scale[:, 2, numpy.newaxis]
+    shear[:, 1:] /= scale[:, 2, numpy.newaxis]
+
+    sign = numpy.where(numpy.einsum('ni,ni->n', row0,
+                                    numpy.cross(row1, row2)) < 0, -1.0, 1.0)
+    scale *= sign[:, numpy.newaxis]
+    row *= sign[:, numpy.newaxis, numpy.newaxis]
+
+    angles[:, 1] = numpy.arcsin(numpy.clip(-row[:, 0, 2], -1.0, 1.0))
+    i = numpy.cos(angles[:, 1]) != 0.0
+    angles[:, 0] = numpy.where(i, numpy.arctan2(row[:, 1, 2], row[:, 2, 2]),
+                               numpy.arctan2(-row[:, 2, 1], row[:, 1, 1]))
+    angles[:, 2] = numpy.where(i, numpy.arctan2(row[:, 0, 1], row[:, 0, 0]),
+                               0.0)
+
+
 def compose_matrix(scale=None, shear=None, angles=None, translate=None,
                    perspective=None):
     """Return transformation matrix from sequence of transformations.
@@ -829,30 +1065,23 @@ def compose_matrix(scale=None, shear=None, angles=None, translate=None,
     True
 
     """
-    M = numpy.identity(4)
-    if perspective is not None:
-        P = numpy.identity(4)
-        P[3, :] = perspective[:4]
-        M = numpy.dot(M, P)
-    if translate is not None:
-        T = numpy.identity(4)
-        T[:3, 3] = translate[:3]
-        M = numpy.dot(M, T)
+    # M = P * T * R * Z * S, where only P has a nontrivial bottom row
     if angles is not None:
-        R = euler_matrix(angles[0], angles[1], angles[2], 'sxyz')
-        M = numpy.dot(M, R)
+        M = euler_matrix(angles[0], angles[1], angles[2], 'sxyz')
+    else:
+        M = _IDENTITY.copy()
+    L = M[:3, :3]
     if shear is not None:
-        Z = numpy.identity(4)
-        Z[1, 2] = shear[2]
-        Z[0, 2] = shear[1]
-        Z[0, 1] = shear[0]
-        M = numpy.dot(M, Z)
+        # columns of R * Z for upper triangular Z
+        L[:, 2] += L[:, 0] * shear[1] + L[:, 1] * shear[2]
+        L[:, 1] += L[:, 0] * shear[0]
     if scale is not None:
-        S = numpy.identity(4)
-        S[0, 0] = scale[0]
-        S[1, 1] = scale[1]
-        S[2, 2] = scale[2]
-        M = numpy.dot(M, S)
+        L *= scale[:3]
+    if translate is not None:
+        M[:3, 3] = translate[:3]
+    if perspective is not None:
+        M[3] = numpy.dot(perspective[:3], M[:3])
+        M[3, 3] += perspective[3]
     M /= M[3, 3]
     return M
 
@@ -873,9 +1102,9 @@ def orthogonalization_matrix(lengths, angles):
 
     """
     a, b, c = lengths
-    angles = numpy.radians(angles)
-    sina, sinb, _ = numpy.sin(angles)
-    cosa, cosb, cosg = numpy.cos(angles)
+    alpha, beta, gamma = [math.radians(x) for x in angles]
+    sina, sinb = math.sin(alpha), math.sin(beta)
+    cosa, cosb, cosg = math.cos(alpha), math.cos(beta), math.cos(gamma)
     co = (cosa * cosb - cosg) / (sina * sinb)
     return numpy.array([
         [ a*sinb*math.sqrt(1.0-co*co),  0.0,    0.0, 0.0],
@@ -925,8 +1154,8 @@ def affine_matrix_from_points(v0, v1, shear=True, scale=True, usesvd=True):
     More examples in superimposition_matrix()
 
     """
-    v0 = numpy.array(v0, dtype=numpy.float64, copy=True)
-    v1 = numpy.array(v1, dtype=numpy.float64, copy=True)
+    v0 = numpy.asarray(v0, dtype=numpy.float64)
+    v1 = numpy.asarray(v1, dtype=numpy.float64)
 
     ndims = v0.shape[0]
     if ndims < 2 or v0.shape[1] < ndims or v0.shape != v1.shape:
@@ -934,22 +1163,26 @@ def affine_matrix_from_points(v0, v1, shear=True, scale=True, usesvd=True):
 
     # move centroids to origin
     t0 = -numpy.mean(v0, axis=1)
-    M0 = numpy.identity(ndims+1)
-    M0[:ndims, ndims] = t0
-    v0 += t0.reshape(ndims, 1)
+    v0 = v0 + t0.reshape(ndims, 1)
     t1 = -numpy.mean(v1, axis=1)
-    M1 = numpy.identity(ndims+1)
-    M1[:ndims, ndims] = t1
-    v1 += t1.reshape(ndims, 1)
+    v1 = v1 + t1.reshape(ndims, 1)
 
     if shear:
         # Affine transformation
         A = numpy.concatenate((v0, v1), axis=0)
-        u, s, vh = numpy.linalg.svd(A.T)
+        # only the right singular vectors are needed
+        if _scipy_svd is not None and A.shape[1] >= _SCIPY_SVD_MIN:
+            # A.T is Fortran ordered and not used again, so LAPACK can
+            # factorize it in place without the copy numpy.linalg makes
+            u, s, vh = _scipy_svd(A.T, full_matrices=False, overwrite_a=True,
+                                  check_finite=False, lapack_driver='gesdd')
+        else:
+            u, s, vh = numpy.linalg.svd(A.T, full_matrices=False)
         vh = vh[:ndims].T
         B = vh[:ndims]
         C = vh[ndims:2*ndims]
-        t = numpy.dot(C, numpy.linalg.pinv(B))
+        # t = C * inv(B)
+        t = numpy.linalg.solve(B.T, C.T).T
         t = numpy.concatenate((t, numpy.zeros((ndims, 1))), axis=1)
         M = numpy.vstack((t, ((0.0,)*ndims) + (1.0,)))
     elif usesvd or ndims != 3:
@@ -967,15 +1200,21 @@ def affine_matrix_from_points(v0, v1, shear=True, scale=True, usesvd=True):
     else:
         # Rigid transformation matrix via quaternion
         # compute symmetric matrix N
-        xx, yy, zz = numpy.sum(v0 * v1, axis=1)
-        xy, yz, zx = numpy.sum(v0 * numpy.roll(v1, -1, axis=0), axis=1)
-        xz, yx, zy = numpy.sum(v0 * numpy.roll(v1, -2, axis=0), axis=1)
-        N = [[xx+yy+zz, 0.0,      0.0,      0.0],
-             [yz-zy,    xx-yy-zz, 0.0,      0.0],
-             [zx-xz,    xy+yx,    yy-xx-zz, 0.0],
-             [xy-yx,    zx+xz,    yz+zy,    zz-xx-yy]]
+        (xx, xy, xz), (yx, yy, yz), (zx, zy, zz) = numpy.dot(v0, v1.T)
+        # only the lower triangle is referenced by eigh
+        N = numpy.zeros((4, 4))
+        N[0, 0] = xx+yy+zz
+        N[1, 0] = yz-zy
+        N[1, 1] = xx-yy-zz
+        N[2, 0] = zx-xz
+        N[2, 1] = xy+yx
+        N[2, 2] = yy-xx-zz
+        N[3, 0] = xy-yx
+        N[3, 1] = zx+xz
+        N[3, 2] = yz+zy
+        N[3, 3] = zz-xx-yy
         # quaternion: eigenvector corresponding to most positive eigenvalue
-        w, V = numpy.linalg.eigh(N)
+        w, V = numpy.linalg.eigh(N, UPLO='L')
         q = V[:, numpy.argmax(w)]
         q /= vector_norm(q)  # unit quaternion
         # homogeneous transformation matrix
@@ -983,12 +1222,13 @@ def affine_matrix_from_points(v0, v1, shear=True, scale=True, usesvd=True):
 
     if scale and not shear:
         # Affine transformation; scale is ratio of RMS deviations from centroid
-        v0 *= v0
-        v1 *= v1
-        M[:ndims, :ndims] *= math.sqrt(numpy.sum(v1) / numpy.sum(v0))
+        M[:ndims, :ndims] *= math.sqrt(numpy.einsum('ij,ij->', v1, v1) /
+                                       numpy.einsum('ij,ij->', v0, v0))
 
-    # move centroids back
-    M = numpy.dot(numpy.linalg.inv(M1), numpy.dot(M, M0))
+    # move centroids back, i.e. M = dot(inv(M1), dot(M, M0)) where M0 and M1
+    # translate by t0 and t1, so that inv(M1) translates by -t1
+    M[:, ndims] += numpy.dot(M[:, :ndims], t0)
+    M[:ndims] -= t1[:, numpy.newaxis] * M[ndims]
     M /= M[ndims, ndims]
     return M
 
@@ -1061,17 +1301,25 @@ def euler_matrix(ai, aj, ak, axes='sxyz'):
     ...    R = euler_matrix(ai, aj, ak, axes)
     >>> for axes in _TUPLE2AXES.keys():
     ...    R = euler_matrix(ai, aj, ak, axes)
+    >>> numpy.allclose(euler_matrix(0, 0, 0, 'rzxz'), numpy.identity(4))
+    True
+    >>> R = euler_matrix(1, 2, 3)
+    >>> R[0, 0] = 0.0
+    >>> numpy.allclose(euler_matrix(1, 2, 3)[0, 0], math.cos(2) * math.cos(3))
+    True
 
     """
+    i, j, k, parity, repetition, frame = _AXES2INDICES[axes]
+    if ai == 0.0 and aj == 0.0 and ak == 0.0:
+        return _IDENTITY.copy()
+    key = (ai, aj, ak, axes)
     try:
-        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes]
-    except (AttributeError, KeyError):
-        _TUPLE2AXES[axes]  # validation
-        firstaxis, parity, repetition, frame = axes
-
-    i = firstaxis
-    j = _NEXT_AXIS[i+parity]
-    k = _NEXT_AXIS[i-parity+1]
+        M = _EULER_CACHE.get(key)
+    except TypeError:
+        # unhashable angle arguments are not cached
+        key = M = None
+    if M is not None:
+        return M.copy()
 
     if frame:
         ai, ak = ak, ai
@@ -1083,30 +1331,80 @@ def euler_matrix(ai, aj, ak, axes='sxyz'):
     cc, cs = ci*ck, ci*sk
     sc, ss = si*ck, si*sk
 
-    M = numpy.identity(4)
+    # store the nine products with one indexed assignment
+    M = numpy.zeros(16)
     if repetition:
-        M[i, i] = cj
-        M[i, j] = sj*si
-        M[i, k] = sj*ci
-        M[j, i] = sj*sk
-        M[j, j] = -cj*ss+cc
-        M[j, k] = -cj*cs-sc
-        M[k, i] = -sj*ck
-        M[k, j] = cj*sc+cs
-        M[k, k] = cj*cc-ss
+        M[_AXES2FLATINDEX[axes]] = (
+            cj, sj*si, sj*ci,
+            sj*sk, -cj*ss+cc, -cj*cs-sc,
+            -sj*ck, cj*sc+cs, cj*cc-ss)
     else:
-        M[i, i] = cj*ck
-        M[i, j] = sj*sc-cs
-        M[i, k] = sj*cc+ss
-        M[j, i] = cj*sk
-        M[j, j] = sj*ss+cc
-        M[j, k] = sj*cs-sc
-        M[k, i] = -sj
-        M[k, j] = cj*si
-        M[k, k] = cj*ci
+        M[_AXES2FLATINDEX[axes]] = (
+            cj*ck, sj*sc-cs, sj*cc+ss,
+            cj*sk, sj*ss+cc, sj*cs-sc,
+            -sj, cj*si, cj*ci)
+    M[15] = 1.0
+    M = M.reshape(4, 4)
+    if key is not None:
+        if len(_EULER_CACHE) >= _EULER_CACHE_SIZE:
+            _EULER_CACHE.clear()
+        _EULER_CACHE[key] = M
+        M = M.copy()
     return M
 
 
+def euler_matrices(angles, axes='sxyz', dtype=numpy.float64):
+    """Return stack of homogeneous rotation matrices from Euler angles.
+
+    angles : array of shape (N, 3) of Euler's roll, pitch and yaw angles
+    axes : One of 24 axis sequences as string or encoded tuple
+
+    >>> angles = (4*math.pi) * (numpy.random.random((5, 3)) - 0.5)
+    >>> for axes in list(_AXES2TUPLE.keys()) + list(_TUPLE2AXES.keys()):
+    ...    R = euler_matrices(angles, axes)
+    ...    if not all(numpy.allclose(R[n], euler_matrix(axes=axes, *angles[n]))
+    ...               for n in range(5)): print(axes, "failed")
+    >>> euler_matrices([1, 2, 3]).shape
+    (1, 4, 4)
+
+    """
+    i, j, k, parity, repetition, frame = _AXES2INDICES[axes]
+
+    angles = numpy.array(angles, dtype=numpy.float64, ndmin=2)
+    if frame:
+        angles = angles[:, ::-1]
+    if parity:
+        angles = -angles
+    si, sj, sk = numpy.sin(angles).T
+    ci, cj, ck = numpy.cos(angles).T
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    M = numpy.zeros((len(angles), 4, 4))
+    if repetition:
+        M[:, i, i] = cj
+        M[:, i, j] = sj*si
+        M[:, i, k] = sj*ci
+        M[:, j, i] = sj*sk
+        M[:, j, j] = -cj*ss+cc
+        M[:, j, k] = -cj*cs-sc
+        M[:, k, i] = -sj*ck
+        M[:, k, j] = cj*sc+cs
+        M[:, k, k] = cj*cc-ss
+    else:
+        M[:, i, i] = cj*ck
+        M[:, i, j] = sj*sc-cs
+        M[:, i, k] = sj*cc+ss
+        M[:, j, i] = cj*sk
+        M[:, j, j] = sj*ss+cc
+        M[:, j, k] = sj*cs-sc
+        M[:, k, i] = -sj
+        M[:, k, j] = cj*si
+        M[:, k, k] = cj*ci
+    M[:, 3, 3] = 1.0
+    return M.astype(dtype, copy=False)
+
+
 def euler_from_matrix(matrix, axes='sxyz'):
     """Return Euler angles from rotation matrix for specified axis sequence.
 
@@ -1127,35 +1425,32 @@ def euler_from_matrix(matrix, axes='sxyz'):
 
     """
     try:
-        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
-    except (AttributeError, KeyError):
-        _TUPLE2AXES[axes]  # validation
-        firstaxis, parity, repetition, frame = axes
-
-    i = firstaxis
-    j = _NEXT_AXIS[i+parity]
-    k = _NEXT_AXIS[i-parity+1]
-
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)[:3, :3]
+        i, j, k, parity, repetition, frame = _AXES2INDICES[axes]
+    except KeyError:
+        i, j, k, parity, repetition, frame = _AXES2INDICES[str(axes).lower()]
+
+    # read the nine elements once as Python floats
+    M = numpy.asarray(matrix, dtype=numpy.float64)[:3, :3].tolist()
+    Mii, Mij, Mik = M[i][i], M[i][j], M[i][k]
+    Mji, Mjj, Mjk = M[j][i], M[j][j], M[j][k]
+    Mki, Mkj, Mkk = M[k][i], M[k][j], M[k][k]
     if repetition:
-        sy = math.sqrt(M[i, j]*M[i, j] + M[i, k]*M[i, k])
+        sy = math.sqrt(Mij*Mij + Mik*Mik)
+        ay = math.atan2(sy, Mii)
         if sy > _EPS:
-            ax = math.atan2( M[i, j],  M[i, k])
-            ay = math.atan2( sy,       M[i, i])
-            az = math.atan2( M[j, i], -M[k, i])
+            ax = math.atan2(Mij,  Mik)
+            az = math.atan2(Mji, -Mki)
         else:
-            ax = math.atan2(-M[j, k],  M[j, j])
-            ay = math.atan2( sy,       M[i, i])
+            ax = math.atan2(-Mjk, Mjj)
             az = 0.0
     else:
-        cy = math.sqrt(M[i, i]*M[i, i] + M[j, i]*M[j, i])
+        cy = math.sqrt(Mii*Mii + Mji*Mji)
+        ay = math.atan2(-Mki, cy)
         if cy > _EPS:
-            ax = math.atan2( M[k, j],  M[k, k])
-            ay = math.atan2(-M[k, i],  cy)
-            az = math.atan2( M[j, i],  M[i, i])
+            ax = math.atan2(Mkj, Mkk)
+            az = math.atan2(Mji, Mii)
         else:
-            ax = math.atan2(-M[j, k],  M[j, j])
-            ay = math.atan2(-M[k, i],  cy)
+            ax = math.atan2(-Mjk, Mjj)
             az = 0.0
 
     if parity:
@@ -1172,8 +1467,69 @@ def euler_from_quaternion(quaternion, axes='sxyz'):
     >>> numpy.allclose(angles, [0.123, 0, 0])
     True
 
+    >>> q = quaternion_from_euler(1, 2, 3, 'rzxz')
+    >>> numpy.allclose(euler_matrix(axes='rzxz', *euler_from_quaternion(q, 'rzxz')),
+    ...                quaternion_matrix(q))
+    True
+
     """
-    return euler_from_matrix(quaternion_matrix(quaternion), axes)
+    try:
+        i, j, k, parity, repetition, frame = _AXES2INDICES[axes]
+    except KeyError:
+        i, j, k, parity, repetition, frame = _AXES2INDICES[str(axes).lower()]
+
+    # angles are extracted directly from the quaternion components
+    # (Bernardes & Vieville 2022) without forming the rotation matrix;
+    # the result is invariant to the norm of the quaternion
+    q = numpy.asarray(quaternion, dtype=numpy.float64)
+    w = float(q[0])
+    qi = float(q[i+1])
+    qj = float(q[j+1])
+    qk = float(q[k+1])
+    if parity:
+        qk = -qk
+    if repetition:
+        a, b, c, d = w, qi, qj, qk
+    else:
+        a, b, c, d = w - qj, qi + qk, qj + w, qk - qi
+    ab = math.hypot(a, b)
+    cd = math.hypot(c, d)
+    if ab + cd < _EPS:
+        return 0.0, 0.0, 0.0
+
+    ay = 2.0 * math.atan2(cd, ab)
+    half_sum = math.atan2(b, a)
+    half_diff = math.atan2(d, c)
+    if 2.0*cd <= _EPS*ab:
+        ax = 2.0 * half_sum
+        az = 0.0
+    elif 2.0*ab <= _EPS*cd:
+        ax = -2.0 * half_diff
+        az = 0.0
+    else:
+        ax = half_sum - half_diff
+        az = half_sum + half_diff
+
+    if not repetition:
+        ay -= math.pi / 2.0
+        if parity:
+            az = -az
+    elif parity:
+        ax += math.pi
+        ay = -ay
+        az += math.pi
+
+    if ax > math.pi:
+        ax -= 2.0 * math.pi
+    elif ax <= -math.pi:
+        ax += 2.0 * math.pi
+    if az > math.pi:
+        az -= 2.0 * math.pi
+    elif az <= -math.pi:
+        az += 2.0 * math.pi
+    if frame:
+        ax, az = az, ax
+    return ax, ay, az
 
 
 def quaternion_from_euler(ai, aj, ak, axes='sxyz'):
@@ -1188,14 +1544,10 @@ def quaternion_from_euler(ai, aj, ak, axes='sxyz'):
 
     """
     try:
-        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
-    except (AttributeError, KeyError):
-        _TUPLE2AXES[axes]  # validation
-        firstaxis, parity, repetition, frame = axes
-
-    i = firstaxis + 1
-    j = _NEXT_AXIS[i+parity-1] + 1
-    k = _NEXT_AXIS[i-parity] + 1
+        i, j, k, parity, repetition, frame = _AXES2INDICES[axes]
+    except KeyError:
+        i, j, k, parity, repetition, frame = _AXES2INDICES[str(axes).lower()]
+    i, j, k = i + 1, j + 1, k + 1
 
     if frame:
         ai, ak = ak, ai
@@ -1266,7 +1618,7 @@ def quaternion_matrix(quaternion):
     q = numpy.array(quaternion, dtype=numpy.float64, copy=True)
     n = numpy.dot(q, q)
     if n < _EPS:
-        return numpy.identity(4)
+        return _IDENTITY.copy()
     q *= math.sqrt(2.0 / n)
     q = numpy.outer(q, q)
     return numpy.array([
@@ -1312,7 +1664,7 @@ def quaternion_from_matrix(matrix, isprecise=False):
     True
 
     """
-    M = numpy.array(matrix, dtype=numpy.float64, copy=False)[:4, :4]
+    M = numpy.asarray(matrix, dtype=numpy.float64)[:4, :4]
     if isprecise:
         q = numpy.empty((4, ))
         t = numpy.trace(M)
@@ -1421,6 +1773,41 @@ def quaternion_imag(quaternion):
     return numpy.array(quaternion[1:4], dtype=numpy.float64, copy=True)
 
 
+def quaternion_rotate(quaternion, vector):
+    """Return vector or (3, N) array of vectors rotated by quaternion.
+
+    Same as numpy.dot(quaternion_matrix(quaternion)[:3, :3], vector).
+    A single vector is rotated without forming the rotation matrix.
+
+    >>> q = quaternion_about_axis(math.pi/2, [0, 0, 1])
+    >>> numpy.allclose(quaternion_rotate(q, [1, 0, 0]), [0, 1, 0])
+    True
+    >>> q = random_quaternion() * 2.0
+    >>> v = numpy.random.random((3, 10)) - 0.5
+    >>> numpy.allclose(quaternion_rotate(q, v),
+    ...                numpy.dot(quaternion_matrix(q)[:3, :3], v))
+    True
+
+    """
+    v = numpy.asarray(vector, dtype=numpy.float64)
+    if v.ndim > 1:
+        # for many vectors one 3x3 matrix product is cheaper
+        return numpy.dot(quaternion_matrix(quaternion)[:3, :3], v[:3])
+    w, qx, qy, qz = [float(x) for x in quaternion[:4]]
+    x, y, z = v[:3].tolist()
+    n = w*w + qx*qx + qy*qy + qz*qz
+    if n < _EPS:
+        return numpy.array([x, y, z])
+    # v + w*t + cross(q_xyz, t) with t = 2*cross(q_xyz, v) / |q|**2
+    n = 2.0 / n
+    tx = (qy*z - qz*y) * n
+    ty = (qz*x - qx*z) * n
+    tz = (qx*y - qy*x) * n
+    return numpy.array([x + w*tx + qy*tz - qz*ty,
+                        y + w*ty + qz*tx - qx*tz,
+                        z + w*tz + qx*ty - qy*tx])
+
+
 def quaternion_slerp(quat0, quat1, fraction, spin=0, shortestpath=True):
     """Return spherical linear interpolation between two quaternions.
 
@@ -1661,6 +2048,17 @@ def arcball_nearest_axis(point, axes):
 # epsilon for testing whether a number is close to zero
 _EPS = numpy.finfo(float).eps * 4.0
 
+# read-only 4x4 identity matrix, copied instead of calling numpy.identity
+_IDENTITY = numpy.identity(4)
+_IDENTITY.flags.writeable = False
+
+# number of matrices decompose_matrices processes at a time
+_DECOMPOSE_BLOCK = 8192
+
+# minimum number of points for which scipy.linalg.svd, if available, is used
+# in the shear branch of affine_matrix_from_points
+_SCIPY_SVD_MIN = 512
+
 # axis sequences for Euler angles
 _NEXT_AXIS = [1, 2, 0, 1]
 
@@ -1677,6 +2075,41 @@ _AXES2TUPLE = {
 
 _TUPLE2AXES = dict((v, k) for k, v in _AXES2TUPLE.items())
 
+# recent euler_matrix results by (ai, aj, ak, axes); callers get copies
+_EULER_CACHE = {}
+_EULER_CACHE_SIZE = 256
+
+# map axes strings and tuples to axis indices i, j, k, parity, repetition,
+# frame as used by the Euler angle functions
+_AXES2INDICES = {}
+for _axes, (_i, _parity, _repetition, _frame) in _AXES2TUPLE.items():
+    _AXES2INDICES[_axes] = _AXES2INDICES[_AXES2TUPLE[_axes]] = (
+        _i, _NEXT_AXIS[_i+_parity], _NEXT_AXIS[_i-_parity+1],
+        _parity, _repetition, _frame)
+
+# flat indices of the rotation elements (i, i), (i, j), ... (k, k) in a
+# 4x4 matrix for each axis sequence, used by euler_matrix
+_AXES2FLATINDEX = {}
+for _axes, (_i, _j, _k, _parity, _repetition, _frame) in _AXES2INDICES.items():
+    _AXES2FLATINDEX[_axes] = numpy.array(
+        [4*_i+_i, 4*_i+_j, 4*_i+_k,
+         4*_j+_i, 4*_j+_j, 4*_j+_k,
+         4*_k+_i, 4*_k+_j, 4*_k+_k], dtype=numpy.intp)
+del _axes, _i, _j, _k, _parity, _repetition, _frame
+
+
+def _unit_vector3(vector):
+    """Return components of first three elements of vector normalized.
+
+    Raise ValueError if the vector has zero length.
+
+    """
+    x, y, z = [float(v) for v in vector[:3]]
+    length = math.sqrt(x*x + y*y + z*z)
+    if length == 0.0:
+        raise ValueError("zero-length vector")
+    return x / length, y / length, z / length
+
 
 def vector_norm(data, axis=None, out=None):
     """Return length, i.e. Euclidean norm, of ndarray along axis.
@@ -1852,11 +2285,28 @@ def concatenate_matrices(*matrices):
     True
     >>> numpy.allclose(numpy.dot(M, M.T), concatenate_matrices(M, M.T))
     True
+    >>> numpy.allclose(concatenate_matrices(), numpy.identity(4))
+    True
+    >>> numpy.allclose(concatenate_matrices(numpy.identity(4) * 1j, M),
+    ...                M * 1j)
+    True
 
     """
-    M = numpy.identity(4)
-    for i in matrices:
-        M = numpy.dot(M, i)
+    if not matrices:
+        return _IDENTITY.copy()
+    M = numpy.array(matrices[0],
+                    dtype=numpy.result_type(matrices[0], numpy.float64))
+    # alternate between two buffers instead of allocating every product
+    T = numpy.empty_like(M)
+    for i in matrices[1:]:
+        try:
+            numpy.dot(M, i, out=T)
+        except ValueError:
+            # product of different shape or type than the buffers
+            M = numpy.dot(M, i)
+            T = numpy.empty_like(M)
+        else:
+            M, T = T, M
     return M
 
 
@@ -1876,11 +2326,13 @@ def is_same_transform(matrix0, matrix1):
     return numpy.allclose(matrix0, matrix1)
 
 
-def _import_module(name, package=None, warn=True, prefix='_py_', ignore='_'):
+def _import_module(name, package=None, warn=True, prefix='_py_', ignore='_',
+                   keep=()):
     """Try import all public attributes from module into global namespace.
 
     Existing attributes with name clashes are renamed with prefix.
     Attributes starting with underscore are ignored by default.
+    Attributes listed in keep are not replaced.
 
     Return True on successful import.
 
@@ -1899,6 +2351,8 @@ def _import_module(name, package=None, warn=True, prefix='_py_', ignore='_'):
         for attr in dir(module):
             if ignore and attr.startswith(ignore):
                 continue
+            if attr in keep:
+                continue
             if prefix:
                 if attr in globals():
                     globals()[prefix + attr] = globals()[attr]
@@ -1907,6 +2361,22 @@ def _import_module(name, package=None, warn=True, prefix='_py_', ignore='_'):
             globals()[attr] = getattr(module, attr)
         return True
 
+
+# functions whose Python versions have features the compiled ones lack:
+# the dtype argument of the matrix constructors and the euler_matrix cache
+_PYTHON_ONLY = (
+    'translation_matrix', 'reflection_matrix', 'rotation_matrix',
+    'scale_matrix', 'projection_matrix', 'clip_matrix', 'shear_matrix',
+    'euler_matrix')
+
+# use the compiled transformations.c implementations where installed,
+# preferring a build shipped inside this package over a global one;
+# the functions above remain available with a _py_ prefix
+if not (__package__ and
+        _import_module('_transformations', __package__, warn=False,
+                       keep=_PYTHON_ONLY)):
+    _import_module('_transformations', warn=False, keep=_PYTHON_ONLY)
+
 if __name__ == "__main__":
     import doctest
     import random  # used in doctests
@@ -1,8 +1,20 @@
-from distutils.core import setup
+import os
+from distutils.core import setup, Extension
+
+# the C implementation of cope.transformation (Christoph Gohlke's
+# transformations.c) is optional and not distributed with this package; it is
+# built as cope._transformations when its source is placed next to the module
+ext_modules = []
+if os.path.exists(os.path.join('cope', 'transformations.c')):
+	import numpy
+	ext_modules.append(Extension('cope._transformations',
+		[os.path.join('cope', 'transformations.c')],
+		include_dirs=[numpy.get_include()]))
 
 setup(name='cope', 
 	version='1.0.0',
 	description='Covariance-based Poses Estimation library',
 	author='Huy Nguyen',
 	author_email='huy.nguyendinh09@gmail.com',
-     packages=['cope'])
+     packages=['cope'],
+	ext_modules=ext_modules)